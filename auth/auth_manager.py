@@ -2,40 +2,84 @@ import os
 import json
 import time
 import logging
-import requests
+import tempfile
+import threading
 from requests.exceptions import RequestException
 import jwt
-import subprocess
-from utils import HttpConfig
+from utils import HttpConfig, HttpTransport
 from config import Config
+from metrics import REGISTRY
 
 logger = logging.getLogger(__name__)
 
+TOKEN_REFRESHES = REGISTRY.counter("kismia_token_refreshes_total", "Token refresh attempts by outcome", ("result",))
+
 class AuthManager:
-    def __init__(self):
+    # With refresh=False the manager never calls the refresh endpoint; it
+    # picks up the tokens another process (the worker supervisor) writes to
+    # the token file. Refresh tokens are single-use, so only one process may
+    # rotate them.
+    def __init__(self, transport=None, refresh=True):
+        self.transport = transport or HttpTransport()
         self.token_file = Config.TOKEN_FILE
         self.refresh_endpoint = f"{HttpConfig.BASE_URL}/rest/v2/login/refresh_token"
+        self.refresh = refresh
         self.token_data = {}
+        self._token_mtime = None
+        # (access_token, exp) decoded once per token instead of once per request
+        self._token_cache = (None, 0)
+        self._refresh_lock = threading.Lock()
+        self._refresh_thread = None
+        self._stop_event = threading.Event()
         self.load_tokens()
 
     def load_tokens(self):
         if os.path.exists(self.token_file):
             try:
+                self._token_mtime = os.stat(self.token_file).st_mtime_ns
                 with open(self.token_file, "r") as f:
                     self.token_data = json.load(f)
+                self._update_token_cache()
                 logger.info("Tokens loaded from file")
             except Exception as e:
                 logger.error(f"Error reading token file: {e}")
         else:
             logger.info("Token file not found. Please populate it with initial token data")
     
+    def reload_tokens(self):
+        # Loads the token file again if it changed since it was last read
+        try:
+            mtime = os.stat(self.token_file).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._token_mtime:
+            return False
+        self.load_tokens()
+        return True
+    
     def save_tokens(self):
+        # Write to a temp file next to the token file and rename it over the
+        # original, so a crash mid-write never leaves a truncated file behind.
+        tmp_path = None
         try:
-            with open(self.token_file, "w") as f:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.token_file) or ".",
+                prefix=".auth_token.",
+                suffix=".tmp"
+            )
+            with os.fdopen(fd, "w") as f:
                 json.dump(self.token_data, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.token_file)
+            tmp_path = None
+            self._token_mtime = os.stat(self.token_file).st_mtime_ns
             logger.info("Tokens saved to file")
         except Exception as e:
             logger.error(f"Error saving token file: {e}")
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
     
     def decode_token(self, token):
         try:
@@ -44,16 +88,24 @@ class AuthManager:
             logger.error(f"Failed to decode JWT: {e}")
             return None
 
-    def is_token_expired(self, token):
-        payload = self.decode_token(token)
-        if not payload or "exp" not in payload:
+    def _update_token_cache(self):
+        access_token = self.token_data.get("accessToken", {}).get("access_token")
+        payload = self.decode_token(access_token) if access_token else None
+        exp = payload.get("exp") if payload else None
+        if access_token and not exp:
             logger.error("Token payload invalid or missing 'exp'")
-            return True
-        exp = payload["exp"]
-        current_time = int(time.time())
-        return current_time >= exp - 60
+        self._token_cache = (access_token, exp or 0)
+    
+    def _token_valid(self, margin):
+        access_token, exp = self._token_cache
+        return access_token if access_token and time.time() < exp - margin else None
 
     def refresh_tokens(self):
+        refreshed = self._refresh_tokens()
+        TOKEN_REFRESHES.inc(result="success" if refreshed else "failure")
+        return refreshed
+
+    def _refresh_tokens(self):
         if "refreshToken" not in self.token_data or "accessToken" not in self.token_data:
             logger.error("Missing tokens required for refresh")
             return False
@@ -66,72 +118,111 @@ class AuthManager:
             return False
         
         auth_token = self.token_data.get("authToken", "")
-        
-        curl_command = (
-            f"curl '{self.refresh_endpoint}' "
-            "-H 'accept: application/json, text/plain, */*' "
-            "-H 'accept-language: en-US,en;q=0.9,ru;q=0.8' "
-            "-H 'cache-control: no-cache' "
-            "-H 'content-type: application/json' "
-            f"-b 'pauth={auth_token}' "
-            "-H 'dnt: 1' "
-            f"-H 'origin: {HttpConfig.BASE_URL}' "
-            "-H 'platform: mobile' "
-            "-H 'platform-version: 2' "
-            "-H 'pragma: no-cache' "
-            "-H 'priority: u=1, i' "
-            f"-H 'referer: {HttpConfig.BASE_URL}/matches' "
-            "-H 'sec-ch-ua: \"Google Chrome\";v=\"135\", \"Not-A.Brand\";v=\"8\", \"Chromium\";v=\"135\"' "
-            "-H 'sec-ch-ua-mobile: ?1' "
-            "-H 'sec-ch-ua-platform: \"Android\"' "
-            "-H 'sec-fetch-dest: empty' "
-            "-H 'sec-fetch-mode: cors' "
-            "-H 'sec-fetch-site: same-origin' "
-            "-H 'user-agent: Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Mobile Safari/537.36' "
-            "-H 'x-client-version: v3mobile-spa/2b5c480eb' "
-            f"--data-raw '{{\"refresh_token\":\"{refresh_token}\",\"access_token\":\"{access_token}\"}}'"
-        )
+        headers = {
+            "accept-language": "en-US,en;q=0.9,ru;q=0.8",
+            "cache-control": "no-cache",
+            "content-type": "application/json",
+            "dnt": "1",
+            "origin": HttpConfig.BASE_URL,
+            "pragma": "no-cache",
+            "referer": f"{HttpConfig.BASE_URL}/matches"
+        }
+        payload = {"refresh_token": refresh_token, "access_token": access_token}
         
         for attempt in range(Config.MAX_RETRIES):
             try:
                 logger.info("Refreshing tokens...")
-                result = subprocess.run(curl_command, shell=True, capture_output=True, text=True)
+                resp = self.transport.request(
+                    "POST", self.refresh_endpoint,
+                    headers=headers, cookies={"pauth": auth_token}, json=payload
+                )
                 
-                if result.returncode == 0 and result.stdout:
-                    try:
-                        data = json.loads(result.stdout)
-                        result_data = data.get("result", {})
-                        if result_data:
-                            self.token_data["refreshToken"] = result_data.get("refreshToken", {})
-                            self.token_data["accessToken"] = result_data.get("accessToken", {})
-                            self.token_data["authToken"] = result_data.get("authToken")
-                            self.token_data["authKey"] = result_data.get("authKey")
-                            self.save_tokens()
-                            logger.info("Tokens refreshed successfully")
-                            return True
-                        else:
-                            logger.error(f"No 'result' in refresh response: {data}")
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Failed to parse refresh response: {e}")
-                else:
-                    logger.error(f"Refresh request failed: {result.stderr}")
-                break
-            except Exception as e:
+                if resp.status_code == 200:
+                    data = resp.json()
+                    result_data = data.get("result", {})
+                    if result_data:
+                        self.token_data["refreshToken"] = result_data.get("refreshToken", {})
+                        self.token_data["accessToken"] = result_data.get("accessToken", {})
+                        self.token_data["authToken"] = result_data.get("authToken")
+                        self.token_data["authKey"] = result_data.get("authKey")
+                        self._update_token_cache()
+                        self.save_tokens()
+                        logger.info("Tokens refreshed successfully")
+                        return True
+                    logger.error(f"No 'result' in refresh response: {data}")
+                    return False
+                elif resp.status_code not in Config.HTTP_RETRY_STATUSES:
+                    logger.error(f"Refresh request rejected with status {resp.status_code}: {resp.text[:200]}")
+                    return False
+                logger.warning(f"Refresh request failed with status {resp.status_code} (attempt {attempt+1}/{Config.MAX_RETRIES})")
+            except (RequestException, ValueError) as e:
                 logger.error(f"Error during token refresh (attempt {attempt+1}/{Config.MAX_RETRIES}): {e}")
-                if attempt < Config.MAX_RETRIES - 1:
-                    time.sleep(Config.RETRY_DELAY)
         
         return False
 
+    def peek_access_token(self):
+        # Valid cached token or None; never refreshes, so it cannot block
+        return self._token_valid(Config.TOKEN_EXPIRY_MARGIN)
+
     def get_access_token(self):
-        if "accessToken" not in self.token_data or "access_token" not in self.token_data["accessToken"]:
-            logger.error("Access token not found in token data")
-            return None
-        access_token = self.token_data["accessToken"]["access_token"]
-        if self.is_token_expired(access_token):
+        access_token = self._token_valid(Config.TOKEN_EXPIRY_MARGIN)
+        if access_token:
+            return access_token
+        
+        # Only one thread refreshes; the others wait and reuse its result
+        with self._refresh_lock:
+            access_token = self._token_valid(Config.TOKEN_EXPIRY_MARGIN)
+            if access_token:
+                return access_token
+            if not self.refresh:
+                # Whatever the refreshing process last wrote, if still valid at all
+                self.reload_tokens()
+                access_token = self._token_valid(0)
+                if not access_token:
+                    logger.error("Access token expired and no fresh one in the token file yet")
+                return access_token
+            if not self._token_cache[0]:
+                logger.error("Access token not found in token data")
+                return None
             logger.info("Access token expired; refreshing")
             if not self.refresh_tokens():
                 logger.error("Failed to refresh tokens")
                 return None
-            access_token = self.token_data["accessToken"].get("access_token")
-        return access_token
+            return self._token_cache[0]
+    
+    def start_background_refresh(self):
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._refresh_thread = threading.Thread(target=self._background_refresh, daemon=True)
+        self._refresh_thread.start()
+    
+    def stop_background_refresh(self):
+        self._stop_event.set()
+        if self._refresh_thread:
+            self._refresh_thread.join()
+            self._refresh_thread = None
+    
+    def _background_refresh(self):
+        while not self._stop_event.is_set():
+            access_token, exp = self._token_cache
+            if not access_token and self.refresh:
+                return
+            wait = exp - Config.TOKEN_REFRESH_AHEAD - time.time()
+            if wait > 0:
+                self._stop_event.wait(wait)
+                continue
+            
+            if not self.refresh:
+                # Poll the token file until the refreshing process has rotated the tokens
+                if not self.reload_tokens():
+                    self._stop_event.wait(Config.RETRY_DELAY)
+                continue
+            
+            with self._refresh_lock:
+                if self._token_valid(Config.TOKEN_REFRESH_AHEAD):
+                    continue
+                logger.info("Access token close to expiry; refreshing in background")
+                refreshed = self.refresh_tokens()
+            if not refreshed:
+                self._stop_event.wait(Config.RETRY_DELAY)
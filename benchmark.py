@@ -0,0 +1,490 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import requests
+import compression
+import json_codec
+from compression import BlobCodec, train_dictionary
+from config import Config
+from db import Database, content_hash, extract_field, format_user_rows
+from fake_server import FakeKismia
+from fetcher import AsyncKismiaAPI, KismiaAPI, async_api
+from pacer import AsyncPacer, Pacer
+from pipeline import DatabaseWriter
+from sharding import open_database
+from utils import HttpTransport
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def make_profile(i):
+    return {
+        "hid": f"bench{i:09d}",
+        "age": 18 + i % 50,
+        "gender": "GENDER_FEMALE" if i % 2 else "GENDER_MALE",
+        "city": {"id": i % 300, "name": f"City {i % 300}"},
+        "interests": ["INTEREST_MUSIC", "INTEREST_TRAVEL", "INTEREST_SPORT"][: 1 + i % 3],
+        "about": f"Looking for someone nice, profile number {i}",
+        "photos": [{"url": f"https://cdn.example.com/{i:x}/{n}.jpg", "width": 640, "height": 640} for n in range(3)]
+    }
+
+def make_hit(i):
+    return {
+        "user": {"hid": f"bench{i:09d}", "name": f"User {i}", "age": 20 + i % 40},
+        "trackingData": "x" * 64,
+        "operationToken": f"op{i}"
+    }
+
+def report(name, rows, elapsed):
+    per_row = elapsed / rows * 1e6 if rows else 0
+    logger.info(f"{name}: {rows} rows in {elapsed:.3f}s ({per_row:.1f} us/row, {rows / elapsed:.0f} rows/s)")
+
+def bench_db_write(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        # Baseline: what Database did before, a fresh rollback-journal
+        # connection and a commit for every row.
+        path = os.path.join(tmp, "connect_per_call.db")
+        Database(path).close()
+        with sqlite3.connect(path) as conn:
+            conn.execute("PRAGMA journal_mode=DELETE")
+        start = time.perf_counter()
+        for i in range(args.rows):
+            hit = make_hit(i)
+            conn = sqlite3.connect(path)
+            with conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO users (hid, data) VALUES (?, ?)",
+                    (hit["user"]["hid"], json.dumps(hit))
+                )
+            conn.close()
+        report("connect per call", args.rows, time.perf_counter() - start)
+
+        db = Database(os.path.join(tmp, "persistent.db"))
+        start = time.perf_counter()
+        for i in range(args.rows):
+            db.save_user(make_hit(i))
+        report(f"persistent {Config.DB_JOURNAL_MODE} writer", args.rows, time.perf_counter() - start)
+        db.close()
+
+def bench_db_bulk(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = open_database(os.path.join(tmp, "bulk.db"), args.shards)
+        for start in range(0, args.existing, 10000):
+            db.save_users_bulk(make_hit(i) for i in range(start, min(start + 10000, args.existing)))
+        logger.info(f"Prefilled {db.count_users()} rows")
+
+        offset = args.existing
+        pages = [[make_hit(offset + p * args.page_size + i) for i in range(args.page_size)] for p in range(args.pages)]
+        start = time.perf_counter()
+        for page in pages:
+            for hit in page:
+                db.save_user(hit)
+        report("save_user per hit", args.pages * args.page_size, time.perf_counter() - start)
+
+        offset += args.pages * args.page_size
+        pages = [[make_hit(offset + p * args.page_size + i) for i in range(args.page_size)] for p in range(args.pages)]
+        inserted = 0
+        start = time.perf_counter()
+        for page in pages:
+            inserted += db.save_users_bulk(page)[0]
+        report("save_users_bulk per page", inserted, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        updated = 0
+        for page in pages:
+            updated += db.save_profiles_bulk((hit["user"]["hid"], {"about": "x" * 200}) for hit in page)[0]
+        report("save_profiles_bulk per page", updated, time.perf_counter() - start)
+        db.close()
+
+def bench_compression(args):
+    if args.db:
+        db = Database(args.db)
+        samples = []
+        for _, data, profile in db.iter_users(raw=True):
+            samples.append(data)
+            if profile:
+                samples.append(profile)
+            if len(samples) >= args.rows:
+                break
+        db.close()
+    else:
+        samples = []
+        for i in range(args.rows // 2):
+            samples.append(json.dumps(make_hit(i)))
+            samples.append(json.dumps(make_profile(i)))
+    if not samples:
+        logger.error("No rows to sample")
+        return
+
+    # Train on one half, measure on the other so the dictionary is not flattered
+    train, test = samples[::2], samples[1::2]
+    raw_size = sum(len(s.encode()) for s in test)
+    variants = [("zlib", False), ("zlib", True)]
+    if compression.zstandard is not None:
+        variants += [("zstd", False), ("zstd", True)]
+    else:
+        logger.info("zstandard not installed, skipping zstd")
+
+    logger.info(f"{len(test)} rows, {raw_size / 1024 / 1024:.2f} MiB of JSON text")
+    for algorithm, with_dict in variants:
+        dictionary = train_dictionary(algorithm, train, Config.DB_COMPRESSION_DICT_SIZE) if with_dict else None
+        codec = BlobCodec(algorithm, Config.DB_COMPRESSION_LEVEL, dictionary=dictionary)
+        start = time.perf_counter()
+        encoded = [codec.encode(s) for s in test]
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for value in encoded:
+            codec.decode(value)
+        decode_time = time.perf_counter() - start
+        size = sum(len(value) for value in encoded)
+        name = f"{algorithm}{' + dictionary' if with_dict else ''}"
+        logger.info(
+            f"{name}: ratio {raw_size / size:.2f}x, "
+            f"encode {raw_size / encode_time / 1024 / 1024:.0f} MiB/s, "
+            f"decode {raw_size / decode_time / 1024 / 1024:.0f} MiB/s"
+        )
+
+def recorded_bodies(args):
+    # Response bodies as they come off the wire: pickUp pages and profile
+    # responses of PROFILE_BATCH_SIZE profiles each, recorded or synthetic
+    pages, profiles = [], []
+    if args.fixtures:
+        fake = FakeKismia(fixtures=args.fixtures)
+        pages = [json.dumps(page).encode() for page in fake.pages]
+        profiles = list(fake.profile_fixtures.values())
+    if not pages:
+        pages = [
+            json.dumps({"hits": [make_hit(p * args.page_size + i) for i in range(args.page_size)], "nextPageToken": str(p + 1)}).encode()
+            for p in range(args.pages)
+        ]
+    if not profiles:
+        profiles = [make_profile(i) for i in range(args.pages * args.page_size)]
+    size = Config.PROFILE_BATCH_SIZE
+    profile_bodies = [json.dumps({"result": profiles[i:i + size]}).encode() for i in range(0, len(profiles), size)]
+    return pages, profile_bodies
+
+def bench_codec(args):
+    # CPU cost per item of what ingest and export do with JSON, for every
+    # installed backend; "json (before)" is the path without the codec layer
+    pages, profile_bodies = recorded_bodies(args)
+    hits = sum(len(json.loads(page)["hits"]) for page in pages)
+    logger.info(f"{len(pages)} pages with {hits} hits, {len(profile_bodies)} profile responses")
+
+    def before_ingest(body, key):
+        return [(item, json.dumps(item)) for item in json.loads(body)[key]]
+
+    variants = [("json (before)", before_ingest, json.loads)]
+    for backend in json_codec.available_backends():
+        codec = json_codec.JsonCodec(backend)
+        ingest = lambda body, key, codec=codec: [(item, codec.dumps(item)) for item in codec.loads(body)[key]]
+        variants.append((backend, ingest, codec.loads))
+
+    for name, ingest, loads in variants:
+        # Ingest: decode the response, find the hid, produce the stored text and its hash
+        cpu = time.process_time()
+        stored = []
+        for key, bodies in (("hits", pages), ("result", profile_bodies)):
+            for body in bodies:
+                for item, text in ingest(body, key):
+                    extract_field(item, "user.hid") or item.get("hid")
+                    content_hash(text)
+                    stored.append(text)
+        ingest_cpu = time.process_time() - cpu
+        # Export: decode every stored row and pull two fields out of it
+        cpu = time.process_time()
+        for text in stored:
+            row = loads(text)
+            extract_field(row, "user.age"), extract_field(row, "city.name")
+        export_cpu = time.process_time() - cpu
+        logger.info(
+            f"{name}: ingest {ingest_cpu / len(stored) * 1e6:.1f} us CPU/item, "
+            f"export {export_cpu / len(stored) * 1e6:.1f} us CPU/item"
+        )
+
+    # Lazy reads: exporting data fields only never decodes the profiles
+    rows = [(f"h{i}", json_codec.dumps(make_hit(i)), json_codec.dumps(make_profile(i))) for i in range(hits)]
+    for fields in (["user.age", "profile_detailed.city.name"], ["user.age"]):
+        cpu = time.process_time()
+        for _ in format_user_rows(rows, fields=fields):
+            pass
+        logger.info(f"export --fields {','.join(fields)}: {(time.process_time() - cpu) / len(rows) * 1e6:.1f} us CPU/row")
+
+def report_latency(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    logger.info(f"{name}: {len(latencies) / elapsed:.0f} req/s, p50 {p50:.2f}ms, p99 {p99:.2f}ms")
+
+def bench_http(args):
+    server = FakeKismia(page_size=1).start()
+    url = f"{server.url}/v3/matchesGame/users:pickUp"
+    # Unpaced, so the numbers show transport cost only
+    transport = HttpTransport(pacer=Pacer(rate=0))
+    clients = [
+        ("requests.request (new connection each call)", lambda: requests.request("GET", url, timeout=Config.REQUEST_TIMEOUT)),
+        ("HttpTransport (pooled session)", lambda: transport.request("GET", url))
+    ]
+    try:
+        for name, call in clients:
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                t = time.perf_counter()
+                call().content
+                latencies.append(time.perf_counter() - t)
+            report_latency(name, latencies, time.perf_counter() - start)
+    finally:
+        transport.close()
+        server.stop()
+
+class StaticAuth:
+    def get_access_token(self):
+        return "benchmark-token"
+
+    def peek_access_token(self):
+        return "benchmark-token"
+
+def zero_delays():
+    # Per-page and per-profile INFO lines would drown the results
+    logging.getLogger("fetcher.kismia_api").setLevel(logging.WARNING)
+    logging.getLogger("fetcher.async_api").setLevel(logging.WARNING)
+    for name in dir(Config):
+        if name.endswith(("_DELAY_MIN", "_DELAY_MAX")) or name in ("RETRY_DELAY", "PROFILE_POLL_INTERVAL"):
+            setattr(Config, name, 0)
+
+def process_usage():
+    with open("/proc/self/status") as f:
+        rss_kb = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+    return rss_kb / 1024, len(os.listdir("/proc/self/fd"))
+
+def bench_soak(args):
+    # Replays synthetic traffic through the real fetch loops and samples RSS
+    # and open file descriptors; both should stay flat once warmed up
+    zero_delays()
+    server = FakeKismia(hid_space=args.hid_space).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "soak.db"))
+        writer = DatabaseWriter(db).start()
+        api = KismiaAPI(StaticAuth(), db, transport=HttpTransport(pacer=Pacer(rate=0)), writer=writer)
+        api.base_url = server.url
+        threads = [
+            threading.Thread(target=api.fetch_batch_users, kwargs={"max_pages": 10 ** 9}, daemon=True),
+            threading.Thread(target=api.continuous_profile_fetch, daemon=True)
+        ]
+        for thread in threads:
+            thread.start()
+
+        samples = []
+        start = time.time()
+        try:
+            while time.time() - start < args.duration:
+                time.sleep(args.interval)
+                rss, fds = process_usage()
+                samples.append((rss, fds))
+                logger.info(f"t={time.time() - start:.0f}s rss={rss:.1f}MiB fds={fds} pages={api.progress['pages']}")
+        finally:
+            api.stop()
+            for thread in threads:
+                thread.join()
+            writer.close()
+            api.transport.close()
+            db.close()
+            server.stop()
+
+    if len(samples) >= 4:
+        warm = samples[len(samples) // 4:]
+        logger.info(
+            f"After warm-up: rss {warm[0][0]:.1f} -> {warm[-1][0]:.1f}MiB (max {max(s[0] for s in warm):.1f}), "
+            f"fds {warm[0][1]} -> {warm[-1][1]} (max {max(s[1] for s in warm)})"
+        )
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def timed_write_batch(db, latencies):
+    write_batch = db.write_batch
+    def wrapper(writes):
+        start = time.perf_counter()
+        try:
+            return write_batch(writes)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    db.write_batch = wrapper
+
+def report_stage(name, items, elapsed, cpu, write_latencies):
+    line = f"{name}: {items} items in {elapsed:.2f}s ({items / max(elapsed, 1e-9):.0f} items/s, {cpu / max(items, 1) * 1000:.2f} ms CPU/item"
+    if write_latencies:
+        latencies = sorted(write_latencies)
+        p50 = statistics.median(latencies) * 1000
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+        line += f", {len(latencies)} commits p50 {p50:.2f}ms p99 {p99:.2f}ms"
+    logger.info(line + ")")
+    return {"items": items, "seconds": elapsed, "cpu_ms_per_item": cpu / max(items, 1) * 1000}
+
+def bench_fetch(args):
+    # Drives the real fetch loops against the local fake server with every
+    # deliberate delay set to zero, so the numbers are pure processing cost
+    zero_delays()
+    server = FakeKismia(
+        page_size=args.page_size, hid_space=args.hid_space, fixtures=args.fixtures,
+        latency=args.latency, error_rate=args.error_rate
+    ).start()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "fetch.db"))
+        write_latencies = []
+        timed_write_batch(db, write_latencies)
+        try:
+            if args.engine == "async":
+                asyncio.run(fetch_async(args, db, server.url, write_latencies, results))
+            else:
+                fetch_threaded(args, db, server.url, write_latencies, results)
+        finally:
+            db.close()
+            server.stop()
+
+    results["peak_rss_mib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results["server_requests"] = server.requests
+    logger.info(f"Peak RSS {results['peak_rss_mib']:.1f}MiB, server saw {server.requests}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+def fetch_threaded(args, db, url, write_latencies, results):
+    writer = DatabaseWriter(db).start()
+    api = KismiaAPI(StaticAuth(), db, transport=HttpTransport(pacer=Pacer(rate=0)), writer=writer)
+    api.base_url = url
+    try:
+        cpu, start = cpu_seconds(), time.perf_counter()
+        api.fetch_batch_users(max_pages=args.pages)
+        results["pick_up"] = report_stage(
+            "fetch_batch_users", api.progress["pages"] * args.page_size,
+            time.perf_counter() - start, cpu_seconds() - cpu, write_latencies
+        )
+
+        write_latencies.clear()
+        pending = db.count_users() - db.count_users_with_profile()
+        profile_thread = threading.Thread(target=api.continuous_profile_fetch, daemon=True)
+        cpu, start = cpu_seconds(), time.perf_counter()
+        profile_thread.start()
+        while db.get_pending_profile_hids(limit=1):
+            time.sleep(0.01)
+        api.stop()
+        profile_thread.join()
+        results["profiles"] = report_stage(
+            "continuous_profile_fetch", pending,
+            time.perf_counter() - start, cpu_seconds() - cpu, write_latencies
+        )
+    finally:
+        api.stop()
+        writer.close()
+        api.transport.close()
+
+async def fetch_async(args, db, url, write_latencies, results):
+    async with AsyncKismiaAPI(StaticAuth(), db, pacer=AsyncPacer(rate=0)) as api:
+        api.base_url = url
+        cpu, start = cpu_seconds(), time.perf_counter()
+        await api.fetch_batch_users(max_pages=args.pages)
+        results["pick_up"] = report_stage(
+            "async fetch_batch_users", api.progress["pages"] * args.page_size,
+            time.perf_counter() - start, cpu_seconds() - cpu, write_latencies
+        )
+
+        write_latencies.clear()
+        pending = db.count_users() - db.count_users_with_profile()
+        cpu, start = cpu_seconds(), time.perf_counter()
+        profile_task = asyncio.create_task(api.continuous_profile_fetch())
+        while db.get_pending_profile_hids(limit=1):
+            await asyncio.sleep(0.01)
+        api.stop()
+        await profile_task
+        results["profiles"] = report_stage(
+            "async continuous_profile_fetch", pending,
+            time.perf_counter() - start, cpu_seconds() - cpu, write_latencies
+        )
+
+def bench_suite(args):
+    # Small, fast run of every benchmark, meant to be compared across commits
+    parser = build_parser()
+    for argv in (
+        ["db-write", "--rows", "500"],
+        ["db-bulk", "--existing", "50000", "--pages", "100"],
+        ["compression", "--rows", "4000"],
+        ["codec", "--pages", "200"],
+        ["http", "--requests", "300"],
+        ["fetch", "--pages", "100"],
+        ["fetch", "--pages", "100", "--engine", "async"],
+    ):
+        if "async" in argv and async_api.aiohttp is None:
+            logger.info("== fetch --engine async skipped: aiohttp is not installed ==")
+            continue
+        logger.info(f"== {argv[0]} ==")
+        sub_args = parser.parse_args(argv)
+        sub_args.func(sub_args)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Kismia parser micro-benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    db_write = subparsers.add_parser("db-write", help="per-row Database.save_user cost")
+    db_write.add_argument("--rows", type=int, default=2000)
+    db_write.set_defaults(func=bench_db_write)
+
+    db_bulk = subparsers.add_parser("db-bulk", help="per-hit vs per-page ingest on a prefilled DB")
+    db_bulk.add_argument("--existing", type=int, default=200000)
+    db_bulk.add_argument("--pages", type=int, default=200)
+    db_bulk.add_argument("--page-size", type=int, default=20)
+    db_bulk.add_argument("--shards", type=int, default=1)
+    db_bulk.set_defaults(func=bench_db_bulk)
+
+    compress = subparsers.add_parser("compression", help="size ratio and throughput of the blob codecs")
+    compress.add_argument("--db", help="sample rows from this database instead of synthetic ones")
+    compress.add_argument("--rows", type=int, default=20000)
+    compress.set_defaults(func=bench_compression)
+
+    codec = subparsers.add_parser("codec", help="per-item JSON cost of ingest and export for every installed JSON backend")
+    codec.add_argument("--fixtures", help="directory with recorded pages.jsonl / profiles.jsonl")
+    codec.add_argument("--pages", type=int, default=1000, help="synthetic pages when there are no recorded ones")
+    codec.add_argument("--page-size", type=int, default=20)
+    codec.set_defaults(func=bench_codec)
+
+    http = subparsers.add_parser("http", help="pooled vs unpooled requests against a local stand-in server")
+    http.add_argument("--requests", type=int, default=1000)
+    http.set_defaults(func=bench_http)
+
+    soak = subparsers.add_parser("soak", help="replay synthetic traffic and watch RSS and file descriptors")
+    soak.add_argument("--duration", type=float, default=3600, help="seconds")
+    soak.add_argument("--interval", type=float, default=10, help="seconds between samples")
+    soak.add_argument("--hid-space", type=int, default=50000)
+    soak.set_defaults(func=bench_soak)
+
+    fetch = subparsers.add_parser("fetch", help="fetch_batch_users and continuous_profile_fetch against the fake server")
+    fetch.add_argument("--pages", type=int, default=200)
+    fetch.add_argument("--page-size", type=int, default=20)
+    fetch.add_argument("--hid-space", type=int, default=1000000)
+    fetch.add_argument("--fixtures", help="directory with recorded pages.jsonl / profiles.jsonl")
+    fetch.add_argument("--latency", type=float, default=0.0, help="simulated server latency in seconds")
+    fetch.add_argument("--error-rate", type=float, default=0.0, help="fraction of injected 503 responses")
+    fetch.add_argument("--engine", choices=("threads", "async"), default="threads", help="async needs aiohttp")
+    fetch.add_argument("--json", help="also write the results to this file")
+    fetch.set_defaults(func=bench_fetch)
+
+    suite = subparsers.add_parser("suite", help="quick run of every benchmark")
+    suite.set_defaults(func=bench_suite)
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressed values are stored as BLOBs laid out as
+#   b"\x00" + algorithm byte + 4-byte dictionary id (0 = none) + payload
+# JSON text never starts with a NUL byte, so plain TEXT rows written before
+# compression was enabled stay readable side by side with compressed ones.
+MARKER = b"\x00"
+ALGORITHMS = {"zlib": b"Z", "zstd": b"S"}
+ALGORITHM_NAMES = {code: name for name, code in ALGORITHMS.items()}
+HEADER = struct.Struct(">cI")
+# zlib re-reads its preset dictionary for every value it compresses, so past
+# a few KiB a bigger dictionary costs more throughput than it saves space
+ZLIB_MAX_DICT_SIZE = 4 * 1024
+
+def dictionary_id(dictionary):
+    # Content-derived ids stay valid when rows are copied between databases
+    return zlib.crc32(dictionary) or 1
+
+def train_dictionary(algorithm, samples, size):
+    samples = [s.encode() if isinstance(s, str) else s for s in samples]
+    if not samples:
+        return None
+    if algorithm == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard package")
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    # zlib has no trainer; a preset dictionary made of real rows works well
+    # because the same keys and enum strings repeat in every payload.
+    # The most useful strings go last, where they are closest to the data.
+    size = min(size, ZLIB_MAX_DICT_SIZE)
+    dictionary = b""
+    for sample in samples:
+        if len(dictionary) + len(sample) > size:
+            break
+        dictionary = sample + dictionary
+    return dictionary or samples[0][-size:]
+
+class BlobCodec:
+    def __init__(self, algorithm=None, level=6, dictionaries=None, dictionary=None):
+        if algorithm not in (None, *ALGORITHMS):
+            raise ValueError(f"Unknown compression algorithm: {algorithm}")
+        if algorithm == "zstd" and zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard package")
+        self.algorithm = algorithm
+        self.level = level
+        self.dictionaries = dict(dictionaries or {})
+        self.dictionary = dictionary
+        self.dictionary_id = dictionary_id(dictionary) if dictionary else 0
+        if dictionary:
+            self.dictionaries[self.dictionary_id] = dictionary
+        self._zstd_dicts = {}
+
+    def encode(self, text):
+        if self.algorithm is None or text is None:
+            return text
+        data = text.encode()
+        if self.algorithm == "zlib":
+            if self.dictionary:
+                compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+                payload = compressor.compress(data) + compressor.flush()
+            else:
+                payload = zlib.compress(data, self.level)
+        else:
+            payload = self._zstd_compressor().compress(data)
+        return MARKER + HEADER.pack(ALGORITHMS[self.algorithm], self.dictionary_id) + payload
+
+    def decode(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        value = bytes(value)
+        if not value.startswith(MARKER):
+            return value.decode()
+        code, dict_id = HEADER.unpack_from(value, 1)
+        payload = value[1 + HEADER.size:]
+        dictionary = None
+        if dict_id:
+            dictionary = self.dictionaries.get(dict_id)
+            if dictionary is None:
+                raise ValueError(f"Compression dictionary {dict_id} is missing")
+
+        algorithm = ALGORITHM_NAMES.get(code)
+        if algorithm == "zlib":
+            if dictionary:
+                decompressor = zlib.decompressobj(zdict=dictionary)
+                return (decompressor.decompress(payload) + decompressor.flush()).decode()
+            return zlib.decompress(payload).decode()
+        if algorithm == "zstd":
+            if zstandard is None:
+                raise RuntimeError("Reading zstd-compressed rows requires the zstandard package")
+            return self._zstd_decompressor(dict_id, dictionary).decompress(payload).decode()
+        raise ValueError(f"Unknown compression code: {code!r}")
+
+    # zstandard contexts are not thread-safe and Database is shared between
+    # threads, so contexts are created per call; only the dictionaries,
+    # the expensive part, are cached.
+    def _zstd_dict(self, dict_id, dictionary):
+        cached = self._zstd_dicts.get(dict_id)
+        if cached is None and dictionary:
+            cached = zstandard.ZstdCompressionDict(dictionary)
+            self._zstd_dicts[dict_id] = cached
+        return cached
+
+    def _zstd_compressor(self):
+        dict_data = self._zstd_dict(self.dictionary_id, self.dictionary)
+        return zstandard.ZstdCompressor(level=self.level, dict_data=dict_data)
+
+    def _zstd_decompressor(self, dict_id, dictionary):
+        dict_data = self._zstd_dict(dict_id, dictionary)
+        return zstandard.ZstdDecompressor(dict_data=dict_data)
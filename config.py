@@ -15,17 +15,101 @@ class Config:
     TOKEN_FILE = os.path.join(DATA_DIR, "auth_token.json")
     DB_FILE = os.path.join(DATA_DIR, "kismia.db")
     
+    # SQLite settings
+    DB_JOURNAL_MODE = "WAL"
+    DB_SYNCHRONOUS = "NORMAL"
+    DB_CACHE_SIZE = -65536  # negative means KiB, so 64 MiB
+    DB_MMAP_SIZE = 256 * 1024 * 1024
+    DB_BUSY_TIMEOUT = 30
+    DB_COMPRESSION = None  # None, "zlib" or "zstd" (needs the zstandard package)
+    DB_COMPRESSION_LEVEL = 6
+    DB_COMPRESSION_DICT_SIZE = 16 * 1024  # zlib dictionaries are capped at 4 KiB
+    # Above 1, users are spread over this many files next to DB_FILE by a
+    # hash of hid; change it only together with `python manage.py reshard`
+    DB_SHARDS = 1
+    
+    # JSON library for stored rows and API responses: "msgspec", "orjson" or
+    # "json"; None picks the first one installed, in that order
+    JSON_BACKEND = None
+    
+    # Writer thread: max queued writes before producers block, max writes per commit
+    WRITER_QUEUE_SIZE = 100
+    WRITER_BATCH_SIZE = 50
+    
+    # Attributes copied from the stored JSON into indexed columns of the
+    # user_attrs table: name -> (source column, dotted JSON path, SQLite type).
+    # After adding one, backfill it with `python manage.py index-attrs`.
+    USER_ATTRIBUTES = {
+        "age": ("data", "user.age", "INTEGER"),
+        "gender": ("data", "user.gender", "TEXT"),
+        "city": ("profile_detailed", "city", "TEXT"),
+        "last_seen": ("profile_detailed", "last_visit", "INTEGER"),
+    }
+    
+    # Columns of `python manage.py snapshot`, in the same form as
+    # USER_ATTRIBUTES; hid is always the first column. Parts are split every
+    # SNAPSHOT_PART_ROWS rows.
+    SNAPSHOT_COLUMNS = dict(USER_ATTRIBUTES)
+    SNAPSHOT_DIR = os.path.join(DATA_DIR, "snapshot")
+    SNAPSHOT_PART_ROWS = 1000000
+    
+    # Metrics: Prometheus text on 127.0.0.1:METRICS_PORT and/or a JSON
+    # snapshot rewritten every METRICS_DUMP_INTERVAL seconds; None disables
+    METRICS_PORT = None
+    METRICS_FILE = None
+    METRICS_DUMP_INTERVAL = 60
+    
+    # Profiling: per-stage times are logged every STAGE_REPORT_EVERY items
+    # (0 disables); SIGUSR1 or `main.py --profile` samples every thread for
+    # PROFILE_DURATION seconds and writes folded stacks to PROFILE_DIR
+    STAGE_REPORT_EVERY = 1000
+    PROFILE_DURATION = 60
+    PROFILE_SAMPLE_INTERVAL = 0.005
+    PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+    
+    # Token settings
+    TOKEN_EXPIRY_MARGIN = 60  # treat the access token as expired this many seconds early
+    TOKEN_REFRESH_AHEAD = 300  # background refresh starts this many seconds before expiry
+    
     # HTTP settings
     REQUEST_TIMEOUT = 30
     MAX_RETRIES = 3
     RETRY_DELAY = 5
+    HTTP_POOL_CONNECTIONS = 4
+    HTTP_POOL_MAXSIZE = 8
+    HTTP_KEEP_ALIVE = True
+    HTTP_RETRY_BACKOFF = 2.5  # urllib3 backoff_factor between retried attempts
+    HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # Likes and passes may already be applied when the server answers with an
+    # error, so they are only repeated after these statuses with a Retry-After
+    HTTP_RETRY_AFTER_STATUSES = (429, 503)
+    
+    # Global request pacing shared by every loop, plus adaptive backoff on
+    # Config.HTTP_RETRY_STATUSES; None disables the rate ceiling
+    RATE_LIMIT_PER_SEC = 1.0
+    RATE_LIMIT_BURST = 2
+    PACER_BACKOFF_FACTOR = 2.0
+    PACER_MAX_SLOWDOWN = 16.0
+    PACER_RECOVERY_FACTOR = 0.8  # per successful response
     
     # Batch fetching settings
     HIDS_FETCH_MAX_PAGES = 10000
     HIDS_PAGE_DELAY_MIN = 2
     HIDS_PAGE_DELAY_MAX = 4
+    SWIPE_DELAY_MIN = 0.5
+    SWIPE_DELAY_MAX = 1.5
     
     # Profile fetching settings
+    PROFILE_BATCH_SIZE = 10  # hids per users_hids[] request
     PROFILE_FETCH_DELAY_MIN = 2
     PROFILE_FETCH_DELAY_MAX = 4
-    PROFILE_POLL_INTERVAL = 5 
\ No newline at end of file
+    PROFILE_POLL_INTERVAL = 5
+    # A claimed batch is reserved for its worker this long; if the worker
+    # dies, the batch is handed out again once the lease runs out
+    PROFILE_LEASE_SECONDS = 300
+    WORKER_SHUTDOWN_TIMEOUT = 60  # seconds main.py --workers waits for a worker to exit before killing it
+    # Once the queue of new users is empty, profiles older than
+    # PROFILE_REFRESH_AFTER seconds are re-fetched, stalest first, at most
+    # PROFILE_REFRESH_PER_HOUR of them per hour (0 disables refreshing)
+    PROFILE_REFRESH_AFTER = 7 * 24 * 3600
+    PROFILE_REFRESH_PER_HOUR = 120 
\ No newline at end of file
@@ -1,107 +1,1119 @@
 import sqlite3
+import hashlib
 import json
+import json_codec
 import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
 from config import Config
+from compression import BlobCodec, dictionary_id
+from metrics import REGISTRY
+from profiling import STAGES
 
 logger = logging.getLogger(__name__)
 
+DB_TRANSACTION_SECONDS = REGISTRY.histogram("kismia_db_transaction_seconds", "Time the writer connection is held per transaction")
+DB_WRITES = REGISTRY.counter("kismia_db_writes_total", "Writes applied through write_batch by kind", ("kind",))
+DB_USERS = REGISTRY.gauge("kismia_db_users", "Users in the database", ("profile",))
+DB_UNCHANGED_PROFILES = REGISTRY.counter("kismia_db_unchanged_profiles_total", "Fetched profiles identical to the stored copy")
+
+ATTR_SOURCES = ("data", "profile_detailed")
+ATTR_OPERATORS = ("=", "!=", "<", "<=", ">", ">=")
+# What write_batch reports for a write that could not be applied
+WRITE_FAILED = {"users": (0, 0), "profiles": (0, 0), "decisions": 0, "requeue": 0, "state": 0}
+
+def content_hash(text):
+    # 64-bit digest of the stored JSON text, as a signed SQLite INTEGER
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+def format_user_rows(rows, raw=False, fields=None):
+    # (hid, data text, profile text) rows as iter_users returns them. With
+    # fields, a column none of them reads is not decoded at all.
+    decode_data = decode_profile = True
+    if fields:
+        decode_profile = any(field.split(".")[0] == "profile_detailed" for field in fields)
+        decode_data = any(field.split(".")[0] != "profile_detailed" for field in fields)
+    for hid, data, profile in rows:
+        if raw:
+            yield hid, data, profile
+            continue
+        user_data = json_codec.loads(data) if decode_data else {}
+        if profile and decode_profile:
+            user_data["profile_detailed"] = json_codec.loads(profile)
+        if fields:
+            yield {field: extract_field(user_data, field) for field in fields}
+        else:
+            yield user_data
+
+def extract_field(obj, path):
+    # Resolve a dotted path such as "user.hid" inside decoded JSON
+    for key in path.split("."):
+        if isinstance(obj, dict):
+            obj = obj.get(key)
+        elif isinstance(obj, list) and key.isdigit() and int(key) < len(obj):
+            obj = obj[int(key)]
+        else:
+            return None
+    return obj
+
 class Database:
     def __init__(self, db_path=None):
         self.db_path = db_path or Config.DB_FILE
+        self._write_lock = threading.RLock()
+        self._writer = None
+        self._local = threading.local()
+        self._readers = {}
+        self._readers_lock = threading.Lock()
         self._init_db()
         
     def _init_db(self):
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
+        with self.transaction() as conn:
+            conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 hid TEXT PRIMARY KEY,
                 data JSON NOT NULL,
                 profile_detailed JSON
             )
             ''')
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS decisions (
+                hid TEXT PRIMARY KEY,
+                decision TEXT NOT NULL,
+                decided_at INTEGER NOT NULL
+            )
+            ''')
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+            ''')
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS codec_dicts (
+                id INTEGER PRIMARY KEY,
+                algorithm TEXT NOT NULL,
+                dictionary BLOB NOT NULL,
+                created_at INTEGER NOT NULL
+            )
+            ''')
+            self._init_profile_queue(conn)
+            self._init_stats(conn)
+            self._init_fetch_state(conn)
+            self._init_user_attrs(conn)
+            self._load_codec(conn, Config.DB_COMPRESSION)
+    
+    def _init_user_attrs(self, conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS user_attrs (hid TEXT PRIMARY KEY)")
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_delete_attrs AFTER DELETE ON users
+        BEGIN
+            DELETE FROM user_attrs WHERE hid = OLD.hid;
+        END
+        ''')
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(user_attrs)")}
+        has_users = conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is not None
+        self._attr_columns = {source: [] for source in ATTR_SOURCES}
+        self._attr_paths = {source: [] for source in ATTR_SOURCES}
+        for name, (source, path, sql_type) in Config.USER_ATTRIBUTES.items():
+            if not re.fullmatch(r"[a-z_][a-z0-9_]*", name) or source not in ATTR_SOURCES:
+                raise ValueError(f"Invalid user attribute definition: {name}")
+            if name not in existing:
+                conn.execute(f"ALTER TABLE user_attrs ADD COLUMN {name} {sql_type}")
+                if has_users:
+                    logger.warning(f"Added user attribute column {name}; run `manage.py index-attrs` to backfill it")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_user_attrs_{name} ON user_attrs ({name})")
+            self._attr_columns[source].append(name)
+            self._attr_paths[source].append(path)
+    
+    def _attr_values(self, source, obj):
+        values = []
+        for path in self._attr_paths[source]:
+            value = extract_field(obj, path)
+            values.append(None if isinstance(value, (dict, list)) else value)
+        return values
+    
+    def _load_codec(self, conn, algorithm):
+        # Every stored dictionary stays available for reading; the newest one
+        # for the configured algorithm is used for writing.
+        dictionaries = {}
+        active = None
+        for dict_id, dict_algorithm, dictionary in conn.execute(
+            "SELECT id, algorithm, dictionary FROM codec_dicts ORDER BY created_at, rowid"
+        ):
+            dictionaries[dict_id] = bytes(dictionary)
+            if dict_algorithm == algorithm:
+                active = bytes(dictionary)
+        self.codec = BlobCodec(algorithm, Config.DB_COMPRESSION_LEVEL, dictionaries, active)
+    
+    def set_compression(self, algorithm, dictionary=None):
+        with self.transaction() as conn:
+            if dictionary:
+                conn.execute(
+                    "INSERT OR IGNORE INTO codec_dicts (id, algorithm, dictionary, created_at) VALUES (?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))",
+                    (dictionary_id(dictionary), algorithm, dictionary)
+                )
+            dictionaries = self.codec.dictionaries
+            self.codec = BlobCodec(algorithm, Config.DB_COMPRESSION_LEVEL, dictionaries, dictionary)
+    
+    def _load(self, value):
+        return json_codec.loads(self.codec.decode(value))
+    
+    def _table_exists(self, conn, name):
+        row = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (name,)
+        ).fetchone()
+        return row is not None
+    
+    def _init_profile_queue(self, conn):
+        # Users still waiting for a detailed profile, kept in sync with the
+        # users table by triggers so picking a batch never scans users.
+        backfill = not self._table_exists(conn, "profile_queue")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS profile_queue (
+            hid TEXT PRIMARY KEY,
+            queued_at INTEGER NOT NULL,
+            lease_owner TEXT,
+            lease_until INTEGER
+        )
+        ''')
+        # Worker processes claim batches by leasing them until lease_until;
+        # queues created before leases existed get the columns added
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(profile_queue)")}
+        for name, sql_type in (("lease_owner", "TEXT"), ("lease_until", "INTEGER")):
+            if name not in existing:
+                conn.execute(f"ALTER TABLE profile_queue ADD COLUMN {name} {sql_type}")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_profile_queue_queued_at ON profile_queue (queued_at)")
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_enqueue_profile AFTER INSERT ON users
+        WHEN NEW.profile_detailed IS NULL
+        BEGIN
+            INSERT OR IGNORE INTO profile_queue (hid, queued_at)
+            VALUES (NEW.hid, CAST(strftime('%s', 'now') AS INTEGER));
+        END
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_dequeue_profile AFTER UPDATE OF profile_detailed ON users
+        WHEN NEW.profile_detailed IS NOT NULL
+        BEGIN
+            DELETE FROM profile_queue WHERE hid = NEW.hid;
+        END
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_delete_profile_queue AFTER DELETE ON users
+        BEGIN
+            DELETE FROM profile_queue WHERE hid = OLD.hid;
+        END
+        ''')
+        if backfill:
+            cursor = conn.execute('''
+            INSERT OR IGNORE INTO profile_queue (hid, queued_at)
+            SELECT hid, CAST(strftime('%s', 'now') AS INTEGER) FROM users WHERE profile_detailed IS NULL
+            ''')
+            if cursor.rowcount > 0:
+                logger.info(f"Queued {cursor.rowcount} existing users without profile")
+    
+    def _init_stats(self, conn):
+        # Row counts kept up to date by triggers, so reading them is a primary
+        # key lookup instead of a table scan. Only a new stats table is filled
+        # by counting; `main.py --recount` repairs drifted values.
+        backfill = not self._table_exists(conn, "stats")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_stats_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE stats SET value = value + 1 WHERE key = 'users';
+            UPDATE stats SET value = value + 1 WHERE key = 'users_with_profile' AND NEW.profile_detailed IS NOT NULL;
+        END
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_stats_update AFTER UPDATE OF profile_detailed ON users
+        WHEN (OLD.profile_detailed IS NULL) != (NEW.profile_detailed IS NULL)
+        BEGIN
+            UPDATE stats SET value = value + (CASE WHEN NEW.profile_detailed IS NULL THEN -1 ELSE 1 END)
+            WHERE key = 'users_with_profile';
+        END
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_stats_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE stats SET value = value - 1 WHERE key = 'users';
+            UPDATE stats SET value = value - 1 WHERE key = 'users_with_profile' AND OLD.profile_detailed IS NOT NULL;
+        END
+        ''')
+        if backfill:
+            self._recount(conn)
+    
+    def _init_fetch_state(self, conn):
+        # When data and profile_detailed were last fetched and a hash of their
+        # JSON. Kept out of users so that confirming an unchanged profile
+        # rewrites this narrow row instead of the large one.
+        backfill = not self._table_exists(conn, "fetch_state")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS fetch_state (
+            hid TEXT PRIMARY KEY,
+            data_hash INTEGER,
+            data_fetched_at INTEGER,
+            profile_hash INTEGER,
+            profile_fetched_at INTEGER
+        )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_fetch_state_profile_fetched_at ON fetch_state (profile_fetched_at)")
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_delete_fetch_state AFTER DELETE ON users
+        BEGIN
+            DELETE FROM fetch_state WHERE hid = OLD.hid;
+        END
+        ''')
+        if backfill:
+            # Profiles of unknown age count as the stalest
+            cursor = conn.execute('''
+            INSERT OR IGNORE INTO fetch_state (hid, profile_fetched_at)
+            SELECT hid, CASE WHEN profile_detailed IS NOT NULL THEN 0 END FROM users
+            ''')
+            if cursor.rowcount > 0:
+                logger.info(f"Recorded fetch state for {cursor.rowcount} existing users")
+    
+    def _recount(self, conn):
+        users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        with_profile = conn.execute("SELECT COUNT(*) FROM users WHERE profile_detailed IS NOT NULL").fetchone()[0]
+        conn.executemany(
+            "INSERT OR REPLACE INTO stats (key, value) VALUES (?, ?)",
+            [("users", users), ("users_with_profile", with_profile)]
+        )
+        return users, with_profile
+    
+    def recount(self):
+        with self.transaction() as conn:
+            stored = dict(conn.execute("SELECT key, value FROM stats"))
+            users, with_profile = self._recount(conn)
+        if (stored.get("users"), stored.get("users_with_profile")) != (users, with_profile):
+            logger.warning(
+                f"Stats were {stored.get('users')} users / {stored.get('users_with_profile')} with profile, "
+                f"recounted {users} / {with_profile}"
+            )
+        return users, with_profile
+    
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=Config.DB_BUSY_TIMEOUT,
+            check_same_thread=False
+        )
+        conn.execute(f"PRAGMA synchronous={Config.DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size={int(Config.DB_CACHE_SIZE)}")
+        conn.execute(f"PRAGMA mmap_size={int(Config.DB_MMAP_SIZE)}")
+        return conn
+    
+    def _get_writer(self):
+        if self._writer is None:
+            conn = self._connect()
+            mode = conn.execute(f"PRAGMA journal_mode={Config.DB_JOURNAL_MODE}").fetchone()[0]
+            if mode.upper() != Config.DB_JOURNAL_MODE.upper():
+                logger.warning(f"Could not switch journal mode to {Config.DB_JOURNAL_MODE}, using {mode}")
+            self._writer = conn
+        return self._writer
+        
+    def _get_reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute("PRAGMA query_only=ON")
+            self._local.conn = conn
+            with self._readers_lock:
+                # Close readers left behind by threads that have exited,
+                # otherwise short-lived threads leak a connection (and its
+                # file descriptors) each
+                for thread in [t for t in self._readers if not t.is_alive()]:
+                    self._readers.pop(thread).close()
+                self._readers[threading.current_thread()] = conn
+        return conn
+    
+    @contextmanager
+    def transaction(self):
+        # All writes share one connection; the lock serializes threads and
+        # `with conn` commits on success or rolls back on error. BEGIN
+        # IMMEDIATE takes SQLite's write lock up front, so other processes
+        # wait out the busy timeout instead of failing when a transaction
+        # that started by reading tries to write.
+        with self._write_lock:
+            conn = self._get_writer()
+            start = time.perf_counter()
+            committing = None
+            try:
+                with conn:
+                    if not conn.in_transaction:
+                        conn.execute("BEGIN IMMEDIATE")
+                    yield conn
+                    committing = time.perf_counter()
+            finally:
+                end = time.perf_counter()
+                DB_TRANSACTION_SECONDS.observe(end - start)
+                if committing is not None:
+                    STAGES.add("commit", end - committing)
+    
+    def close(self):
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._readers_lock:
+            for conn in self._readers.values():
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._readers = {}
+        self._local = threading.local()
+        
+    def _insert_users(self, conn, hits):
+        rows = []
+        meta_rows = []
+        attr_rows = []
+        now = int(time.time())
+        for hit in hits:
+            hid = hit.get("user", {}).get("hid")
+            if hid:
+                text = json_codec.dumps(hit)
+                rows.append((hid, self.codec.encode(text)))
+                meta_rows.append((hid, content_hash(text), now))
+                attr_rows.append((hid, *self._attr_values("data", hit)))
+        if not rows:
+            return 0, 0
+        
+        cursor = conn.executemany(
+            "INSERT OR IGNORE INTO users (hid, data) VALUES (?, ?)",
+            rows
+        )
+        inserted = cursor.rowcount
+        # Like data itself, the hash and time are those of the first sighting
+        conn.executemany(
+            "INSERT OR IGNORE INTO fetch_state (hid, data_hash, data_fetched_at) VALUES (?, ?, ?)",
+            meta_rows
+        )
+        if self._attr_columns["data"]:
+            columns = ", ".join(self._attr_columns["data"])
+            placeholders = ", ".join("?" * len(self._attr_columns["data"]))
+            conn.executemany(
+                f"INSERT OR IGNORE INTO user_attrs (hid, {columns}) VALUES (?, {placeholders})",
+                attr_rows
+            )
+        return inserted, len(rows)
+    
+    def _update_profiles(self, conn, profiles):
+        texts = {}
+        for hid, profile in profiles:
+            if hid and profile:
+                texts[hid] = (profile, json_codec.dumps(profile))
+        if not texts:
+            return 0, 0
         
-    def _get_connection(self):
-        return sqlite3.connect(self.db_path)
+        hids = list(texts)
+        stored = dict(conn.execute(
+            f"SELECT hid, profile_hash FROM fetch_state WHERE hid IN ({', '.join('?' * len(hids))})",
+            hids
+        ))
+        now = int(time.time())
+        rows = []
+        meta_rows = []
+        attr_rows = []
+        unchanged = 0
+        for hid, (profile, text) in texts.items():
+            digest = content_hash(text)
+            meta_rows.append((hid, digest, now))
+            if stored.get(hid) == digest:
+                # Same content: only the fetch time moves forward
+                unchanged += 1
+                continue
+            rows.append((self.codec.encode(text), hid))
+            attr_rows.append((hid, *self._attr_values("profile_detailed", profile)))
         
+        updated = 0
+        if rows:
+            cursor = conn.executemany(
+                "UPDATE users SET profile_detailed = ? WHERE hid = ?",
+                rows
+            )
+            updated = cursor.rowcount
+        conn.executemany(
+            """
+            INSERT INTO fetch_state (hid, profile_hash, profile_fetched_at)
+            SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE hid = ?1)
+            ON CONFLICT(hid) DO UPDATE SET profile_hash = excluded.profile_hash, profile_fetched_at = excluded.profile_fetched_at
+            """,
+            meta_rows
+        )
+        if unchanged:
+            DB_UNCHANGED_PROFILES.inc(unchanged)
+        if attr_rows and self._attr_columns["profile_detailed"]:
+            names = self._attr_columns["profile_detailed"]
+            updates = ", ".join(f"{name} = excluded.{name}" for name in names)
+            conn.executemany(
+                f"""
+                INSERT INTO user_attrs (hid, {", ".join(names)})
+                SELECT ?, {", ".join("?" * len(names))} WHERE EXISTS (SELECT 1 FROM users WHERE hid = ?1)
+                ON CONFLICT(hid) DO UPDATE SET {updates}
+                """,
+                attr_rows
+            )
+        return updated + unchanged, len(texts)
+    
     def save_user(self, user_data):
         hid = user_data.get("user", {}).get("hid")
         if not hid:
             return False
             
         try:
-            with self._get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "INSERT OR IGNORE INTO users (hid, data) VALUES (?, ?)",
-                    (hid, json.dumps(user_data))
-                )
-                return cursor.rowcount > 0
+            with self.transaction() as conn:
+                inserted, _ = self._insert_users(conn, [user_data])
+                return inserted > 0
         except Exception as e:
             logger.error(f"Error saving user {hid}: {e}")
             return False
             
+    def save_users_bulk(self, hits):
+        try:
+            with self.transaction() as conn:
+                inserted, total = self._insert_users(conn, hits)
+            return inserted, total - inserted
+        except Exception as e:
+            logger.error(f"Error saving users: {e}")
+            return 0, 0
+            
     def save_user_profile(self, hid, profile_data):
         if not hid or not profile_data:
             return False
             
         try:
-            with self._get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "UPDATE users SET profile_detailed = ? WHERE hid = ?",
-                    (json.dumps(profile_data), hid)
-                )
-                return cursor.rowcount > 0
+            with self.transaction() as conn:
+                updated, _ = self._update_profiles(conn, [(hid, profile_data)])
+                return updated > 0
         except Exception as e:
             logger.error(f"Error saving profile for user {hid}: {e}")
             return False
     
-    def get_users_without_profile(self, limit=100):
+    def save_profiles_bulk(self, profiles):
+        try:
+            with self.transaction() as conn:
+                updated, total = self._update_profiles(conn, profiles)
+            return updated, total - updated
+        except Exception as e:
+            logger.error(f"Error saving profiles: {e}")
+            return 0, 0
+    
+    def _save_decisions(self, conn, hids, decision):
+        rows = [(hid, decision) for hid in hids]
+        if not rows:
+            return 0
+        cursor = conn.executemany(
+            "INSERT OR REPLACE INTO decisions (hid, decision, decided_at) VALUES (?, ?, CAST(strftime('%s', 'now') AS INTEGER))",
+            rows
+        )
+        return cursor.rowcount
+    
+    def save_decision(self, hid, decision):
+        try:
+            with self.transaction() as conn:
+                self._save_decisions(conn, [hid], decision)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving decision for user {hid}: {e}")
+            return False
+    
+    def save_decisions_bulk(self, hids, decision):
+        try:
+            with self.transaction() as conn:
+                return self._save_decisions(conn, hids, decision)
+        except Exception as e:
+            logger.error(f"Error saving {decision} decisions: {e}")
+            return 0
+    
+    def get_decided_hids(self, decision):
+        try:
+            cursor = self._get_reader().execute(
+                "SELECT hid FROM decisions WHERE decision = ?",
+                (decision,)
+            )
+            return {row[0] for row in cursor}
+        except Exception as e:
+            logger.error(f"Error loading {decision} decisions: {e}")
+            return set()
+    
+    def _pending_profiles(self, limit):
+        return self._get_reader().execute(
+            "SELECT queued_at, hid FROM profile_queue ORDER BY queued_at LIMIT ?",
+            (limit,)
+        ).fetchall()
+    
+    def get_pending_profile_hids(self, limit=100):
+        try:
+            return [hid for _, hid in self._pending_profiles(limit)]
+        except Exception as e:
+            logger.error(f"Error fetching pending profile hids: {e}")
+            return []
+    
+    def _claim_profiles(self, conn, owner, limit, lease_seconds):
+        now = int(time.time())
+        return conn.execute(
+            """
+            UPDATE profile_queue SET lease_owner = ?, lease_until = ?
+            WHERE hid IN (
+                SELECT hid FROM profile_queue
+                WHERE lease_until IS NULL OR lease_until <= ?
+                ORDER BY queued_at LIMIT ?
+            )
+            RETURNING queued_at, hid
+            """,
+            (owner, now + lease_seconds, now, limit)
+        ).fetchall()
+    
+    def claim_profiles(self, owner, limit=100, lease_seconds=None):
+        # Leases the oldest unclaimed queue entries to `owner` and returns
+        # their hids. One statement in one write transaction, so two
+        # processes never get the same hid while its lease runs.
+        lease_seconds = Config.PROFILE_LEASE_SECONDS if lease_seconds is None else lease_seconds
+        try:
+            with self.transaction() as conn:
+                rows = self._claim_profiles(conn, owner, limit, lease_seconds)
+            return [hid for _, hid in sorted(rows)]
+        except Exception as e:
+            logger.error(f"Error claiming profile hids: {e}")
+            return []
+    
+    def complete_profiles(self, owner, hids):
+        # Ends owner's leases on hids. Fetched profiles have already left the
+        # queue through the users_dequeue_profile trigger; whatever is still
+        # queued becomes claimable again right away. Returns that count.
+        rows = [(hid, owner) for hid in hids]
+        if not rows:
+            return 0
         try:
-            with self._get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT hid, data FROM users WHERE profile_detailed IS NULL LIMIT ?",
-                    (limit,)
+            with self.transaction() as conn:
+                cursor = conn.executemany(
+                    "UPDATE profile_queue SET lease_owner = NULL, lease_until = NULL WHERE hid = ? AND lease_owner = ?",
+                    rows
                 )
-                return [(row[0], json.loads(row[1])) for row in cursor.fetchall()]
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Error completing profile leases: {e}")
+            return 0
+    
+    def reclaim_profiles(self, owner=None):
+        # Releases every lease held by `owner` (a worker that exited), or
+        # without one every lease that has run out. Returns the count.
+        try:
+            with self.transaction() as conn:
+                if owner is not None:
+                    cursor = conn.execute(
+                        "UPDATE profile_queue SET lease_owner = NULL, lease_until = NULL WHERE lease_owner = ?",
+                        (owner,)
+                    )
+                else:
+                    cursor = conn.execute(
+                        "UPDATE profile_queue SET lease_owner = NULL, lease_until = NULL WHERE lease_until <= ?",
+                        (int(time.time()),)
+                    )
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Error reclaiming profile leases: {e}")
+            return 0
+    
+    def _stale_profiles(self, fetched_before, limit):
+        return self._get_reader().execute(
+            """
+            SELECT profile_fetched_at, hid FROM fetch_state
+            WHERE profile_fetched_at IS NOT NULL AND profile_fetched_at < ?
+            ORDER BY profile_fetched_at LIMIT ?
+            """,
+            (fetched_before, limit)
+        ).fetchall()
+    
+    def get_stale_profile_hids(self, fetched_before, limit=100):
+        # Users whose profile was last fetched before the given time, stalest first
+        try:
+            return [hid for _, hid in self._stale_profiles(fetched_before, limit)]
+        except Exception as e:
+            logger.error(f"Error fetching stale profile hids: {e}")
+            return []
+    
+    def _claim_stale_profiles(self, conn, fetched_before, limit, lease_seconds):
+        return conn.execute(
+            """
+            UPDATE fetch_state SET profile_fetched_at = ?
+            WHERE hid IN (
+                SELECT hid FROM fetch_state
+                WHERE profile_fetched_at IS NOT NULL AND profile_fetched_at < ?
+                ORDER BY profile_fetched_at LIMIT ?
+            )
+            RETURNING hid
+            """,
+            (fetched_before + lease_seconds, fetched_before, limit)
+        ).fetchall()
+    
+    def claim_stale_profiles(self, fetched_before, limit=100, lease_seconds=None):
+        # Like get_stale_profile_hids, but the picked profiles count as
+        # fetched lease_seconds later than the cutoff, so other workers skip
+        # them for that long. A successful refresh then sets the real time.
+        lease_seconds = Config.PROFILE_LEASE_SECONDS if lease_seconds is None else lease_seconds
+        try:
+            with self.transaction() as conn:
+                return [hid for hid, in self._claim_stale_profiles(conn, int(fetched_before), limit, lease_seconds)]
+        except Exception as e:
+            logger.error(f"Error claiming stale profile hids: {e}")
+            return []
+    
+    def _requeue_profiles(self, conn, hids, owner):
+        # Only owner's leases are dropped: a late requeue must not free a hid
+        # another worker has claimed since
+        rows = [(hid,) for hid in hids]
+        if not rows:
+            return 0
+        cursor = conn.executemany(
+            "UPDATE profile_queue SET queued_at = CAST(strftime('%s', 'now') AS INTEGER), lease_owner = NULL, lease_until = NULL "
+            "WHERE hid = ? AND (lease_owner IS NULL OR lease_owner = ?)",
+            [(hid, owner) for hid in hids]
+        )
+        requeued = cursor.rowcount
+        # A stored profile the API no longer returns goes to the back of the refresh order
+        conn.executemany(
+            "UPDATE fetch_state SET profile_fetched_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE hid = ? AND profile_fetched_at IS NOT NULL",
+            rows
+        )
+        return requeued
+    
+    def requeue_profiles(self, owner, hids):
+        try:
+            with self.transaction() as conn:
+                return self._requeue_profiles(conn, hids, owner)
+        except Exception as e:
+            logger.error(f"Error requeueing profiles: {e}")
+            return 0
+    
+    def _set_state(self, conn, values):
+        conn.executemany(
+            "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+            [(key, json.dumps(value)) for key, value in values.items()]
+        )
+        return len(values)
+    
+    def set_state(self, key, value):
+        try:
+            with self.transaction() as conn:
+                self._set_state(conn, {key: value})
+            return True
+        except Exception as e:
+            logger.error(f"Error saving state {key}: {e}")
+            return False
+    
+    def get_state(self, key, default=None):
+        try:
+            row = self._get_reader().execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+            return json.loads(row[0]) if row else default
+        except Exception as e:
+            logger.error(f"Error loading state {key}: {e}")
+            return default
+    
+    def get_all_state(self):
+        rows = self._get_reader().execute("SELECT key, value FROM state").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+    
+    def iter_decisions(self, batch_size=1000):
+        last_hid = ""
+        while True:
+            rows = self._get_reader().execute(
+                "SELECT hid, decision, decided_at FROM decisions WHERE hid > ? ORDER BY hid LIMIT ?",
+                (last_hid, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_hid = rows[-1][0]
+    
+    def _import_users(self, conn, rows):
+        # Copies (hid, data text, profile text[, fetch state]) rows as yielded
+        # by _iter_rows, e.g. from another database; existing hids are left
+        # alone. Rows with their fetch state keep their fetch times and
+        # hashes; without it, the hashes are computed and imported profiles
+        # count as the stalest.
+        rows = list(rows)
+        if not rows:
+            return 0
+        cursor = conn.executemany(
+            "INSERT OR IGNORE INTO users (hid, data, profile_detailed) VALUES (?, ?, ?)",
+            [(hid, self.codec.encode(data), self.codec.encode(profile)) for hid, data, profile, *_ in rows]
+        )
+        imported = cursor.rowcount
+        state_rows = []
+        for hid, data, profile, *state in rows:
+            if state and state[0] is not None:
+                state_rows.append((hid, *state[0]))
+            else:
+                state_rows.append((hid, content_hash(data), None, content_hash(profile) if profile else None, 0 if profile else None))
+        conn.executemany(
+            "INSERT OR IGNORE INTO fetch_state (hid, data_hash, data_fetched_at, profile_hash, profile_fetched_at) VALUES (?, ?, ?, ?, ?)",
+            state_rows
+        )
+        names = self._attr_columns["data"] + self._attr_columns["profile_detailed"]
+        if names:
+            conn.executemany(
+                f"INSERT OR IGNORE INTO user_attrs (hid, {', '.join(names)}) VALUES (?, {', '.join('?' * len(names))})",
+                [
+                    (
+                        hid,
+                        *self._attr_values("data", json_codec.loads(data)),
+                        *self._attr_values("profile_detailed", json_codec.loads(profile) if profile else None)
+                    )
+                    for hid, data, profile, *_ in rows
+                ]
+            )
+        return imported
+    
+    def import_users(self, rows):
+        with self.transaction() as conn:
+            return self._import_users(conn, rows)
+    
+    def _import_decisions(self, conn, rows):
+        cursor = conn.executemany(
+            "INSERT OR REPLACE INTO decisions (hid, decision, decided_at) VALUES (?, ?, ?)",
+            list(rows)
+        )
+        return cursor.rowcount
+    
+    def import_decisions(self, rows):
+        with self.transaction() as conn:
+            return self._import_decisions(conn, rows)
+    
+    def vacuum(self):
+        # VACUUM cannot run inside a transaction
+        with self._write_lock:
+            self._get_writer().execute("VACUUM")
+    
+    def _apply_write(self, conn, kind, payload):
+        if kind == "users":
+            inserted, total = self._insert_users(conn, payload)
+            return inserted, total - inserted
+        if kind == "profiles":
+            updated, total = self._update_profiles(conn, payload)
+            return updated, total - updated
+        if kind == "decisions":
+            hids, decision = payload
+            return self._save_decisions(conn, hids, decision)
+        if kind == "requeue":
+            hids, owner = payload
+            return self._requeue_profiles(conn, hids, owner)
+        if kind == "state":
+            return self._set_state(conn, payload)
+        raise ValueError(f"Unknown write kind: {kind}")
+    
+    def write_batch(self, writes):
+        # Group commit: several queued (kind, payload) writes, one transaction.
+        # If the batch fails, each write is retried alone so one bad write
+        # cannot take the others down with it.
+        try:
+            with self.transaction() as conn:
+                results = []
+                for kind, payload in writes:
+                    # Includes encoding rows to JSON; the COMMIT itself is the "commit" stage
+                    with STAGES.time(f"write_{kind}"):
+                        results.append(self._apply_write(conn, kind, payload))
+            for kind, _ in writes:
+                DB_WRITES.inc(kind=kind)
+            return results
+        except Exception as e:
+            if len(writes) == 1:
+                kind = writes[0][0]
+                logger.error(f"Error applying {kind} write: {e}")
+                return [WRITE_FAILED[kind]]
+            logger.warning(f"Group commit of {len(writes)} writes failed ({e}); applying them one by one")
+            return [self.write_batch([write])[0] for write in writes]
+    
+    def get_users_without_profile(self, limit=100):
+        try:
+            cursor = self._get_reader().execute(
+                '''
+                SELECT u.hid, u.data FROM profile_queue q
+                JOIN users u ON u.hid = q.hid
+                ORDER BY q.queued_at LIMIT ?
+                ''',
+                (limit,)
+            )
+            return [(row[0], self._load(row[1])) for row in cursor.fetchall()]
         except Exception as e:
             logger.error(f"Error fetching users without profile: {e}")
             return []
             
     def get_all_users(self, limit=1000, offset=0):
         try:
-            with self._get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT hid, data, profile_detailed FROM users LIMIT ? OFFSET ?",
-                    (limit, offset)
-                )
-                result = []
-                for row in cursor.fetchall():
-                    user_data = json.loads(row[1])
-                    if row[2]:
-                        user_data["profile_detailed"] = json.loads(row[2])
-                    result.append(user_data)
-                return result
+            cursor = self._get_reader().execute(
+                "SELECT hid, data, profile_detailed FROM users LIMIT ? OFFSET ?",
+                (limit, offset)
+            )
+            result = []
+            for row in cursor.fetchall():
+                user_data = self._load(row[1])
+                if row[2]:
+                    user_data["profile_detailed"] = self._load(row[2])
+                result.append(user_data)
+            return result
         except Exception as e:
             logger.error(f"Error fetching all users: {e}")
             return []
             
-    def count_users(self, with_profile=False):
-        query = "SELECT COUNT(*) FROM users"
-        if with_profile:
-            query += " WHERE profile_detailed IS NOT NULL"
+    def _iter_rows(self, batch_size=1000, after_hid=None, fetch_state=False):
+        # Keyset pagination on the primary key: every batch is an index seek,
+        # and only one batch is held in memory at a time. Yields the stored
+        # JSON text, already decompressed. With fetch_state, every row also
+        # carries its (data_hash, data_fetched_at, profile_hash,
+        # profile_fetched_at) from the fetch_state table.
+        if fetch_state:
+            query = '''
+            SELECT u.hid, u.data, u.profile_detailed,
+                   f.data_hash, f.data_fetched_at, f.profile_hash, f.profile_fetched_at
+            FROM users u LEFT JOIN fetch_state f ON f.hid = u.hid
+            WHERE u.hid > ? ORDER BY u.hid LIMIT ?
+            '''
+        else:
+            query = "SELECT hid, data, profile_detailed FROM users WHERE hid > ? ORDER BY hid LIMIT ?"
+        last_hid = after_hid or ""
+        while True:
+            rows = self._get_reader().execute(query, (last_hid, batch_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                hid, data, profile = row[:3]
+                if fetch_state:
+                    state = row[3:] if any(value is not None for value in row[3:]) else None
+                    yield hid, self.codec.decode(data), self.codec.decode(profile), state
+                else:
+                    yield hid, self.codec.decode(data), self.codec.decode(profile)
+            last_hid = rows[-1][0]
+    
+    def iter_users(self, batch_size=1000, raw=False, fields=None, after_hid=None):
+        return format_user_rows(self._iter_rows(batch_size, after_hid), raw, fields)
+    
+    def last_rowid(self):
+        # (rowid, hid) of the newest users row, or (0, None) when empty
+        return self._get_reader().execute(
+            "SELECT rowid, hid FROM users ORDER BY rowid DESC LIMIT 1"
+        ).fetchone() or (0, None)
+    
+    def hid_at_rowid(self, rowid):
+        row = self._get_reader().execute("SELECT hid FROM users WHERE rowid = ?", (rowid,)).fetchone()
+        return row[0] if row else None
+    
+    def iter_rows_since(self, after_rowid, up_to_rowid, changed_since=None, batch_size=1000):
+        # Decoded (hid, data, profile) of the rows inserted after after_rowid
+        # (up to up_to_rowid), then of the older rows whose profile was
+        # fetched at or after changed_since. Both passes are keyset-paginated
+        # over an index.
+        last_rowid = after_rowid
+        while True:
+            rows = self._get_reader().execute(
+                "SELECT rowid, hid, data, profile_detailed FROM users WHERE rowid > ? AND rowid <= ? ORDER BY rowid LIMIT ?",
+                (last_rowid, up_to_rowid, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            for _, hid, data, profile in rows:
+                yield hid, self.codec.decode(data), self.codec.decode(profile)
+            last_rowid = rows[-1][0]
+        if changed_since is None:
+            return
+        last = (changed_since, "")
+        while True:
+            rows = self._get_reader().execute(
+                """
+                SELECT f.profile_fetched_at, u.hid, u.data, u.profile_detailed
+                FROM fetch_state f JOIN users u ON u.hid = f.hid
+                WHERE (f.profile_fetched_at, f.hid) > (?, ?) AND u.rowid <= ? AND u.profile_detailed IS NOT NULL
+                ORDER BY f.profile_fetched_at, f.hid LIMIT ?
+                """,
+                (*last, after_rowid, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            for _, hid, data, profile in rows:
+                yield hid, self.codec.decode(data), self.codec.decode(profile)
+            last = rows[-1][:2]
+    
+    def get_user(self, hid):
+        try:
+            row = self._get_reader().execute(
+                "SELECT data, profile_detailed FROM users WHERE hid = ?", (hid,)
+            ).fetchone()
+        except Exception as e:
+            logger.error(f"Error fetching user {hid}: {e}")
+            return None
+        if row is None:
+            return None
+        user_data = self._load(row[0])
+        if row[1]:
+            user_data["profile_detailed"] = self._load(row[1])
+        return user_data
+    
+    def _attr_where(self, filters):
+        # Filters are name=value or name=(operator, value), where operator is a
+        # comparison, "in" with a sequence, or "between" with a (low, high) pair
+        clauses = []
+        params = []
+        for name, condition in filters.items():
+            if name not in Config.USER_ATTRIBUTES:
+                raise ValueError(f"Unknown user attribute: {name}")
+            operator, value = condition if isinstance(condition, tuple) else ("=", condition)
+            if value is None and operator in ("=", "!="):
+                clauses.append(f"{name} IS {'NOT ' if operator == '!=' else ''}NULL")
+            elif operator == "in":
+                value = list(value)
+                clauses.append(f"{name} IN ({', '.join('?' * len(value))})")
+                params.extend(value)
+            elif operator == "between":
+                clauses.append(f"{name} BETWEEN ? AND ?")
+                params.extend(value)
+            elif operator in ATTR_OPERATORS:
+                clauses.append(f"{name} {operator} ?")
+                params.append(value)
+            else:
+                raise ValueError(f"Unknown operator for {name}: {operator}")
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+    
+    def count_where(self, **filters):
+        where, params = self._attr_where(filters)
+        try:
+            return self._get_reader().execute(f"SELECT COUNT(*) FROM user_attrs{where}", params).fetchone()[0]
+        except Exception as e:
+            logger.error(f"Error counting users by attributes: {e}")
+            return 0
+    
+    def find_hids(self, limit=100, **filters):
+        where, params = self._attr_where(filters)
+        try:
+            cursor = self._get_reader().execute(f"SELECT hid FROM user_attrs{where} LIMIT ?", (*params, limit))
+            return [row[0] for row in cursor]
+        except Exception as e:
+            logger.error(f"Error finding users by attributes: {e}")
+            return []
+    
+    def group_count(self, attribute, **filters):
+        if attribute not in Config.USER_ATTRIBUTES:
+            raise ValueError(f"Unknown user attribute: {attribute}")
+        where, params = self._attr_where(filters)
+        try:
+            cursor = self._get_reader().execute(
+                f"SELECT {attribute}, COUNT(*) FROM user_attrs{where} GROUP BY {attribute} ORDER BY COUNT(*) DESC",
+                params
+            )
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error grouping users by {attribute}: {e}")
+            return []
+    
+    def _attr_row(self, hid, data, profile):
+        # (hid, *attribute values) from a users row as stored
+        return (
+            hid,
+            *self._attr_values("data", self._load(data)),
+            *self._attr_values("profile_detailed", self._load(profile) if profile else None)
+        )
+    
+    def _upsert_attrs(self, conn, attr_rows):
+        names = self._attr_columns["data"] + self._attr_columns["profile_detailed"]
+        if not names or not attr_rows:
+            return
+        columns = ", ".join(names)
+        placeholders = ", ".join("?" * len(names))
+        updates = ", ".join(f"{name} = excluded.{name}" for name in names)
+        conn.executemany(
+            f"INSERT INTO user_attrs (hid, {columns}) VALUES (?, {placeholders}) ON CONFLICT(hid) DO UPDATE SET {updates}",
+            attr_rows
+        )
+    
+    def _index_user_attrs(self, conn, hids, chunk_size=500):
+        # Re-extracts the attributes of these hids from their rows in `conn`,
+        # for writers that change users without going through this class
+        if not self._attr_columns["data"] + self._attr_columns["profile_detailed"]:
+            return
+        hids = list(hids)
+        for start in range(0, len(hids), chunk_size):
+            part = hids[start:start + chunk_size]
+            rows = conn.execute(
+                f"SELECT hid, data, profile_detailed FROM users WHERE hid IN ({', '.join('?' * len(part))})",
+                part
+            ).fetchall()
+            self._upsert_attrs(conn, [self._attr_row(*row) for row in rows])
+    
+    def rebuild_user_attrs(self, batch_size=1000):
+        if not self._attr_columns["data"] + self._attr_columns["profile_detailed"]:
+            return 0
+        
+        last_hid = ""
+        rebuilt = 0
+        while True:
+            rows = self._get_reader().execute(
+                "SELECT hid, data, profile_detailed FROM users WHERE hid > ? ORDER BY hid LIMIT ?",
+                (last_hid, batch_size)
+            ).fetchall()
+            if not rows:
+                return rebuilt
             
+            attr_rows = [self._attr_row(*row) for row in rows]
+            with self.transaction() as conn:
+                self._upsert_attrs(conn, attr_rows)
+            rebuilt += len(rows)
+            last_hid = rows[-1][0]
+            logger.info(f"Indexed attributes of {rebuilt} rows")
+    
+    def recompress(self, batch_size=1000):
+        # Rewrites every row with the current codec, one batch per transaction
+        last_hid = ""
+        rewritten = 0
+        while True:
+            rows = self._get_reader().execute(
+                "SELECT hid, data, profile_detailed FROM users WHERE hid > ? ORDER BY hid LIMIT ?",
+                (last_hid, batch_size)
+            ).fetchall()
+            if not rows:
+                return rewritten
+            
+            updates = [
+                (self.codec.encode(self.codec.decode(data)), self.codec.encode(self.codec.decode(profile)), hid)
+                for hid, data, profile in rows
+            ]
+            with self.transaction() as conn:
+                conn.executemany("UPDATE users SET data = ?, profile_detailed = ? WHERE hid = ?", updates)
+            rewritten += len(rows)
+            last_hid = rows[-1][0]
+            logger.info(f"Rewrote {rewritten} rows")
+    
+    def count_users(self, with_profile=False):
+        key = "users_with_profile" if with_profile else "users"
         try:
-            with self._get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(query)
-                return cursor.fetchone()[0]
+            row = self._get_reader().execute("SELECT value FROM stats WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else 0
         except Exception as e:
             logger.error(f"Error counting users: {e}")
             return 0
     
     def count_users_with_profile(self):
-        return self.count_users(with_profile=True) 
\ No newline at end of file
+        return self.count_users(with_profile=True)
+    
+    def progress_counts(self):
+        # Both counts read from one snapshot, so they always agree
+        try:
+            stats = dict(self._get_reader().execute(
+                "SELECT key, value FROM stats WHERE key IN ('users', 'users_with_profile')"
+            ))
+        except Exception as e:
+            logger.error(f"Error reading stats: {e}")
+            stats = {}
+        users, with_profile = stats.get("users", 0), stats.get("users_with_profile", 0)
+        DB_USERS.set(users, profile="any")
+        DB_USERS.set(with_profile, profile="fetched")
+        return users, with_profile 
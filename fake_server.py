@@ -0,0 +1,203 @@
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import jwt
+
+logger = logging.getLogger(__name__)
+
+PICK_UP_PATH = "/v3/matchesGame/users:pickUp"
+DECISION_PREFIX = "/v3/matchesGame/users/"
+PROFILE_PATH = "/rest/v2/user/info/profile"
+REFRESH_PATH = "/rest/v2/login/refresh_token"
+
+class FakeKismiaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, route, respond):
+        fake = self.server.fake
+        fake.count(route)
+        fake.simulate_latency()
+        if fake.should_fail():
+            fake.count("errors")
+            headers = {"Retry-After": str(fake.retry_after)} if fake.retry_after is not None else None
+            self._send_json({"error": "injected"}, status=fake.error_status, headers=headers)
+            return
+        self._send_json(respond())
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        fake = self.server.fake
+        if url.path == PICK_UP_PATH:
+            page = int(query.get("pageToken", ["0"])[0])
+            self._handle("pick_up", lambda: fake.pick_up_page(page))
+        elif url.path == PROFILE_PATH:
+            hids = query.get("users_hids[]", [])
+            self._handle("profile", lambda: {"result": fake.profiles(hids)})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        path = urlparse(self.path).path
+        fake = self.server.fake
+        if path.startswith(DECISION_PREFIX) and path.endswith(":like"):
+            self._handle("like", lambda: {})
+        elif path.startswith(DECISION_PREFIX) and path.endswith(":pass"):
+            self._handle("pass", lambda: {})
+        elif path == REFRESH_PATH:
+            self._handle("refresh", lambda: {"result": fake.refreshed_tokens()})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+class FakeKismia:
+    # Local stand-in for every Kismia endpoint the fetcher and AuthManager
+    # use. It plays back recorded fixtures when given a directory holding
+    # pages.jsonl (one pickUp response per line) and/or profiles.jsonl (one
+    # profile per line, with its hid), and synthesizes the rest. Synthetic hids
+    # are drawn from a bounded space, as on the live site where the same
+    # users come around again.
+    def __init__(self, page_size=20, hid_space=50000, fixtures=None, latency=0.0, jitter=0.0,
+                 error_rate=0.0, error_status=503, retry_after=None, token_lifetime=3600, seed=0):
+        self.page_size = page_size
+        self.hid_space = hid_space
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.token_lifetime = token_lifetime
+        self.random = random.Random(seed)
+        self.pages = []
+        self.profile_fixtures = {}
+        self.requests = {}
+        self._lock = threading.Lock()
+        self.server = None
+        if fixtures:
+            self.load_fixtures(fixtures)
+
+    def load_fixtures(self, directory):
+        pages_file = os.path.join(directory, "pages.jsonl")
+        if os.path.exists(pages_file):
+            with open(pages_file) as f:
+                self.pages = [json.loads(line) for line in f if line.strip()]
+        profiles_file = os.path.join(directory, "profiles.jsonl")
+        if os.path.exists(profiles_file):
+            with open(profiles_file) as f:
+                for line in f:
+                    if line.strip():
+                        profile = json.loads(line)
+                        self.profile_fixtures[profile.get("hid")] = profile
+        logger.info(f"Loaded {len(self.pages)} pages and {len(self.profile_fixtures)} profiles from {directory}")
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self, port=0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), FakeKismiaHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def count(self, route):
+        with self._lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+
+    def simulate_latency(self):
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def should_fail(self):
+        return self.error_rate > 0 and self.random.random() < self.error_rate
+
+    def pick_up_page(self, page):
+        if self.pages:
+            # Recorded pages are replayed in a loop, chained by page number
+            data = dict(self.pages[page % len(self.pages)])
+            data["nextPageToken"] = str(page + 1)
+            return data
+        hits = []
+        for _ in range(self.page_size):
+            n = self.random.randrange(self.hid_space)
+            hits.append({
+                "user": {"hid": f"fake{n:08d}", "name": f"User {n}", "age": 18 + n % 50},
+                "trackingData": f"{self.random.getrandbits(128):032x}",
+                "operationToken": f"{self.random.getrandbits(64):016x}"
+            })
+        return {"hits": hits, "nextPageToken": str(page + 1)}
+
+    def profiles(self, hids):
+        return [
+            self.profile_fixtures.get(hid) or
+            {"hid": hid, "city": f"City {sum(map(ord, hid)) % 300}", "last_visit": 1700000000, "about": "x" * 200}
+            for hid in hids
+        ]
+
+    def refreshed_tokens(self):
+        access_token = jwt.encode({"exp": int(time.time()) + self.token_lifetime}, "fake-kismia-signing-key-0000000000")
+        return {
+            "accessToken": {"access_token": access_token},
+            "refreshToken": {"refresh_token": f"refresh-{self.random.getrandbits(64):016x}"},
+            "authToken": f"auth-{self.random.getrandbits(64):016x}",
+            "authKey": "fake"
+        }
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Local stand-in for the Kismia API")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--fixtures", help="directory with pages.jsonl and/or profiles.jsonl")
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--hid-space", type=int, default=50000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=int, help="Retry-After seconds sent with injected errors")
+    args = parser.parse_args()
+
+    fake = FakeKismia(
+        page_size=args.page_size, hid_space=args.hid_space, fixtures=args.fixtures,
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        error_status=args.error_status, retry_after=args.retry_after
+    ).start(port=args.port)
+    logger.info(f"Serving fake Kismia API on {fake.url}; point Config.BASE_URL there")
+    try:
+        while True:
+            time.sleep(60)
+            logger.info(f"Requests so far: {fake.requests}")
+    except KeyboardInterrupt:
+        fake.stop()
+
+if __name__ == "__main__":
+    main()
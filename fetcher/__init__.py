@@ -1 +1,2 @@
-from fetcher.kismia_api import KismiaAPI 
\ No newline at end of file
+from fetcher.kismia_api import KismiaAPI
+from fetcher.async_api import AsyncKismiaAPI
\ No newline at end of file
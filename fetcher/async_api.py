@@ -0,0 +1,432 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+import json_codec
+from config import Config
+from db import WRITE_FAILED
+from sharding import open_database
+from pacer import AsyncPacer
+from profiling import STAGES
+from utils import HttpConfig, HTTP_LATENCY, HTTP_REQUESTS, endpoint_label
+from fetcher.kismia_api import (
+    DECISION_LIKE, DECISION_PASS, ITEMS, LIKE_HEADERS, PICKUP_HEADERS, PICKUP_STATE_KEY,
+    PROFILE_HEADERS, RefreshScheduler, lease_owner, migrate_json_decisions, profile_hid, should_retry
+)
+
+logger = logging.getLogger(__name__)
+
+class AsyncResponse:
+    # The parts of a response the fetch loops use, read in full before the
+    # connection goes back to the pool
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json_codec.loads(self.content)
+
+class AsyncKismiaAPI:
+    # asyncio counterpart of KismiaAPI: the same pick-up, like/pass and
+    # profile operations, but every loop runs as a task on one event loop,
+    # so shared state needs no locks and an extra loop costs no thread.
+    # SQLite writes run on a single executor thread and are group committed.
+    def __init__(self, auth_manager, db=None, pacer=None):
+        if aiohttp is None:
+            raise RuntimeError("The async engine needs the aiohttp package: pip install aiohttp")
+        self.auth_manager = auth_manager
+        self.db = db or open_database()
+        self.pacer = pacer or AsyncPacer()
+        self.base_url = HttpConfig.BASE_URL
+        self.session = None
+        self._auth_headers = (None, None)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._pending = []
+        self._flusher = None
+        self._stopping = False
+
+        self.progress = self.db.get_state(PICKUP_STATE_KEY) or {
+            "page_token": None, "pages": 0, "saved": 0, "liked": 0, "passed": 0, "skipped": 0
+        }
+        self.next_page_token = self.progress.get("page_token")
+        if self.next_page_token:
+            logger.info(f"Resuming pagination after page {self.progress['pages']}")
+
+        migrate_json_decisions(self.db, os.path.join(Config.DATA_DIR, "passed_users.json"), DECISION_PASS)
+        migrate_json_decisions(self.db, os.path.join(Config.DATA_DIR, "liked_users.json"), DECISION_LIKE)
+        self.passed_users = self.db.get_decided_hids(DECISION_PASS)
+        self.liked_users = self.db.get_decided_hids(DECISION_LIKE)
+        self.like_probability = 0.5
+        self.refresh = RefreshScheduler(self.db)
+        self.worker_id = lease_owner()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(
+            limit=Config.HTTP_POOL_MAXSIZE,
+            force_close=not Config.HTTP_KEEP_ALIVE
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=HttpConfig.get_common_headers(),
+            cookies=HttpConfig.get_common_cookies(),
+            timeout=aiohttp.ClientTimeout(total=Config.REQUEST_TIMEOUT)
+        )
+
+    async def close(self):
+        # Everything submitted before close() is still written
+        while self._flusher is not None and not self._flusher.done():
+            await self._flusher
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        self._executor.shutdown(wait=True)
+
+    def stop(self):
+        # Safe to call from a signal handler or another thread
+        self._stopping = True
+        self.pacer.interrupt()
+
+    def _submit(self, kind, payload):
+        # Queues a write and returns a future for its result. Writes queued
+        # while a commit is running go into the next one together.
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((kind, payload, future))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush())
+        return future
+
+    async def _run_db(self, func, *args):
+        # Claims and completions take the write lock and may wait out the
+        # busy timeout, so like every write they run on the writer thread
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _backpressure(self, future):
+        # Producers wait for their own write once too many are waiting
+        if len(self._pending) >= Config.WRITER_QUEUE_SIZE:
+            with STAGES.time("write_wait"):
+                await asyncio.wait({future})
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            batch = self._pending[:Config.WRITER_BATCH_SIZE]
+            self._pending = self._pending[Config.WRITER_BATCH_SIZE:]
+            writes = [(kind, payload) for kind, payload, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, self.db.write_batch, writes)
+            except Exception as e:
+                logger.error(f"Error writing batch of {len(batch)}: {e}")
+                results = [WRITE_FAILED[kind] for kind, _ in writes]
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def get_headers(self, additional_headers=None):
+        # Refreshing blocks on HTTP, so it runs off the event loop
+        with STAGES.time("headers"):
+            access_token = self.auth_manager.peek_access_token()
+            if not access_token:
+                loop = asyncio.get_running_loop()
+                access_token = await loop.run_in_executor(None, self.auth_manager.get_access_token)
+        if not access_token:
+            logger.error("Could not get a valid access token")
+            return None
+
+        cached_token, headers = self._auth_headers
+        if cached_token != access_token:
+            headers = {
+                "authorization": f"JWT {access_token}",
+                "referer": f"{self.base_url}/matches"
+            }
+            self._auth_headers = (access_token, headers)
+
+        if additional_headers:
+            return {**headers, **additional_headers}
+        return headers
+
+    async def make_request(self, method, url, **kwargs):
+        endpoint = endpoint_label(url)
+        for attempt in range(Config.MAX_RETRIES):
+            await self.pacer.acquire()
+            start = time.perf_counter()
+            try:
+                async with self.session.request(method, url, **kwargs) as resp:
+                    response = AsyncResponse(resp.status, resp.headers, await resp.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                HTTP_LATENCY.observe(time.perf_counter() - start, endpoint=endpoint)
+                STAGES.add("network", time.perf_counter() - start)
+                HTTP_REQUESTS.inc(endpoint=endpoint, status="error")
+                self.pacer.record(None)
+                logger.warning(f"Request failed (attempt {attempt+1}/{Config.MAX_RETRIES}): {e!r}")
+                if attempt >= Config.MAX_RETRIES - 1:
+                    logger.error(f"Max retries reached for request to {url}")
+                    raise
+                continue
+
+            elapsed = time.perf_counter() - start
+            HTTP_LATENCY.observe(elapsed, endpoint=endpoint)
+            STAGES.add("network", elapsed)
+            HTTP_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+            self.pacer.record(response.status_code, response.headers.get("Retry-After"))
+            if should_retry(method, response) and attempt < Config.MAX_RETRIES - 1:
+                logger.warning(f"Request got status {response.status_code} (attempt {attempt+1}/{Config.MAX_RETRIES}), retrying")
+                continue
+            return response
+
+    async def pass_on_user(self, hid, tracking_data=None, operation_token=None):
+        if hid in self.passed_users:
+            logger.info(f"Already passed on user {hid}")
+            return True
+
+        self.passed_users.add(hid)
+        self._submit("decisions", ([hid], DECISION_PASS))
+
+        try:
+            url = f"{self.base_url}/v3/matchesGame/users/{operation_token}:pass"
+            headers = await self.get_headers()
+            if not headers:
+                return False
+
+            json_data = {"interactionMethod": "INTERACTION_METHOD_CLICK"}
+            if tracking_data:
+                json_data["trackingData"] = tracking_data
+
+            resp = await self.make_request("POST", url, headers=headers, json=json_data)
+            if resp.status_code == 200:
+                logger.info(f"Successfully passed on user {hid}")
+            else:
+                logger.info(f"API rejected pass for {hid} with status {resp.status_code}")
+            return True
+        except Exception as e:
+            logger.error(f"Error attempting to pass on user {hid}: {e!r}")
+            return True
+
+    async def like_user(self, hid, tracking_data=None, operation_token=None):
+        if hid in self.liked_users:
+            logger.info(f"Already liked user {hid}")
+            return True
+
+        try:
+            url = f"{self.base_url}/v3/matchesGame/users/{operation_token}:like"
+            headers = await self.get_headers(LIKE_HEADERS)
+            if not headers:
+                return False
+
+            json_data = {"interactionMethod": "INTERACTION_METHOD_CLICK"}
+            if tracking_data:
+                json_data["trackingData"] = tracking_data
+
+            resp = await self.make_request("POST", url, headers=headers, json=json_data)
+            if resp.status_code in [200, 400]:
+                self.liked_users.add(hid)
+                self._submit("decisions", ([hid], DECISION_LIKE))
+                log_msg = "Successfully liked" if resp.status_code == 200 else "Like request sent to"
+                logger.info(f"{log_msg} user {hid}")
+                return True
+            logger.error(f"API rejected like for {hid} with status {resp.status_code}")
+            return False
+        except Exception as e:
+            logger.error(f"Error attempting to like user {hid}: {e!r}")
+            return False
+
+    async def fetch_batch_users(self, max_pages=None, like_probability=None):
+        max_pages = max_pages or Config.HIDS_FETCH_MAX_PAGES
+        like_prob = like_probability if like_probability is not None else self.like_probability
+        batch_url = f"{self.base_url}/v3/matchesGame/users:pickUp"
+
+        for page in range(max_pages):
+            if self._stopping:
+                break
+            headers = await self.get_headers(PICKUP_HEADERS)
+            if not headers:
+                break
+
+            url = batch_url if not self.next_page_token else f"{batch_url}?pageToken={self.next_page_token}"
+            try:
+                resp = await self.make_request("GET", url, headers=headers)
+                if resp.status_code != 200:
+                    logger.error(f"Request failed with status: {resp.status_code}")
+                    break
+
+                with STAGES.time("json"):
+                    data = resp.json()
+                hits = data.get("hits", [])
+                logger.info(f"Fetched {len(hits)} users from batch API")
+
+                stats = {"saved": 0, "passed": 0, "liked": 0, "skipped": 0}
+                saved = self._submit("users", list(hits))
+                await self._backpressure(saved)
+
+                for hit in hits:
+                    if self._stopping:
+                        break
+                    if 'user' in hit and 'hid' in hit['user']:
+                        hid = hit['user']['hid']
+                        if hid in self.liked_users or hid in self.passed_users:
+                            stats["skipped"] += 1
+                            continue
+
+                        if random.random() < like_prob:
+                            if await self.like_user(hid, hit.get('trackingData'), hit.get('operationToken')):
+                                stats["liked"] += 1
+                        else:
+                            if await self.pass_on_user(hid, hit.get('trackingData'), hit.get('operationToken')):
+                                stats["passed"] += 1
+
+                        await self.pacer.delay(Config.SWIPE_DELAY_MIN, Config.SWIPE_DELAY_MAX)
+
+                with STAGES.time("write_wait"):
+                    stats["saved"], _ = await saved
+                for key, value in stats.items():
+                    ITEMS.inc(value, kind=f"users_{key}")
+                logger.info(f"\033[92mAdded {stats['saved']} new items\033[0m")
+                logger.info(f"Liked {stats['liked']}, passed on {stats['passed']}, skipped {stats['skipped']} out of {len(hits)} users")
+                if self._stopping:
+                    # The page was cut short; its token is not checkpointed so it is redone
+                    break
+                logger.info(f"Page {page + 1} processed")
+
+                self.next_page_token = data.get("nextPageToken")
+                self._checkpoint_page(stats)
+                ITEMS.inc(kind="pages")
+                STAGES.count_items(len(hits))
+                if not self.next_page_token:
+                    logger.info("No nextPageToken found; ending pagination")
+                    break
+            except Exception as e:
+                logger.error(f"Error fetching items: {e!r}")
+                await self.pacer.delay(Config.RETRY_DELAY, Config.RETRY_DELAY)
+                continue
+
+            await self.pacer.delay(Config.HIDS_PAGE_DELAY_MIN, Config.HIDS_PAGE_DELAY_MAX)
+
+        total_users, _ = await self._run_db(self.db.progress_counts)
+        logger.info(f"Total users in database: {total_users}")
+        return total_users
+
+    def _checkpoint_page(self, stats):
+        self.progress["page_token"] = self.next_page_token
+        self.progress["pages"] += 1
+        for key, value in stats.items():
+            self.progress[key] = self.progress.get(key, 0) + value
+        self._submit("state", {PICKUP_STATE_KEY: dict(self.progress)})
+
+    async def fetch_user_profiles(self, hids):
+        profile_url = f"{self.base_url}/rest/v2/user/info/profile"
+        headers = await self.get_headers(PROFILE_HEADERS)
+        if not headers:
+            return None
+
+        params = [("data_group", "profile")] + [("users_hids[]", hid) for hid in hids]
+        try:
+            resp = await self.make_request("GET", profile_url, headers=headers, params=params)
+            if resp.status_code != 200:
+                logger.error(f"Profile fetch failed for {len(hids)} hids with status: {resp.status_code}")
+                return None
+
+            with STAGES.time("json"):
+                results = resp.json().get("result") or []
+            if len(hids) == 1 and len(results) == 1 and not profile_hid(results[0]):
+                return {hids[0]: results[0]}
+
+            requested = set(hids)
+            profiles = {}
+            for profile in results:
+                hid = profile_hid(profile)
+                if hid in requested and profile:
+                    profiles[hid] = profile
+            logger.info(f"Fetched {len(profiles)}/{len(hids)} profiles")
+            return profiles
+        except Exception as e:
+            logger.error(f"Exception while fetching profiles for {len(hids)} hids: {e!r}")
+        return None
+
+    async def process_profiles_batch(self, limit=50):
+        # New users first; only when none are waiting, refresh stale profiles.
+        # Claiming leases the batch, so other worker processes skip it.
+        hids = await self._run_db(self.db.claim_profiles, self.worker_id, limit)
+        refreshing = not hids
+        if refreshing:
+            hids = await self._run_db(self.refresh.next_batch, limit)
+        processed_count = 0
+        batch_size = max(1, Config.PROFILE_BATCH_SIZE)
+        writes = []
+        requeues = []
+
+        for start in range(0, len(hids), batch_size):
+            if self._stopping:
+                break
+            chunk = hids[start:start + batch_size]
+            profiles = await self.fetch_user_profiles(chunk)
+            if profiles is not None:
+                future = self._submit("profiles", list(profiles.items()))
+                writes.append(future)
+                ITEMS.inc(len(profiles), kind="profiles_fetched")
+                STAGES.count_items(len(profiles))
+                missing = [hid for hid in chunk if hid not in profiles]
+                if missing:
+                    ITEMS.inc(len(missing), kind="profiles_missing")
+                    logger.warning(f"No profile data for {len(missing)} hids, requeueing")
+                    requeues.append(self._submit("requeue", (missing, self.worker_id)))
+                await self._backpressure(future)
+
+            await self.pacer.delay(Config.PROFILE_FETCH_DELAY_MIN, Config.PROFILE_FETCH_DELAY_MAX)
+
+        # The next batch is picked from the queue, so it must see these writes;
+        # requeues also have to land before the leases below are released
+        for future in writes:
+            with STAGES.time("write_wait"):
+                saved, _ = await future
+            processed_count += saved
+        for future in requeues:
+            with STAGES.time("write_wait"):
+                await future
+        if not refreshing:
+            # Hids that were not fetched (errors, shutdown) are free to claim again
+            await self._run_db(self.db.complete_profiles, self.worker_id, hids)
+
+        if refreshing:
+            ITEMS.inc(processed_count, kind="profiles_refreshed")
+            if processed_count:
+                logger.info(f"Refreshed {processed_count} stale profiles")
+            return processed_count
+        ITEMS.inc(processed_count, kind="profiles_saved")
+        logger.info(f"Processed {processed_count} new profiles")
+        total_users, total_with_profile = await self._run_db(self.db.progress_counts)
+        logger.info(f"Progress: {total_with_profile}/{total_users} profiles fetched")
+        return processed_count
+
+    async def continuous_profile_fetch(self):
+        while not self._stopping:
+            processed = await self.process_profiles_batch()
+            if processed == 0 and not self._stopping:
+                logger.info("No new profiles to process, waiting...")
+                with STAGES.time("poll"):
+                    await self.pacer.sleep(Config.PROFILE_POLL_INTERVAL)
+
+    async def run(self, pick_up=False, profiles=True, max_pages=None):
+        # Every enabled loop runs as a task on the current event loop
+        loops = []
+        if pick_up:
+            loops.append(self.fetch_batch_users(max_pages=max_pages))
+        if profiles:
+            loops.append(self.continuous_profile_fetch())
+        await asyncio.gather(*loops)
@@ -1,73 +1,188 @@
 import logging
 import requests
-import time
+import threading
 import random
 import json
 import os
-from utils import HttpConfig
+import socket
+import time
+import json_codec
+from utils import HttpConfig, HttpTransport
 from config import Config
-from db import Database
+from sharding import open_database
+from pipeline import DatabaseWriter
+from metrics import REGISTRY
+from profiling import STAGES
 
 logger = logging.getLogger(__name__)
 
+ITEMS = REGISTRY.counter("kismia_items_total", "Items handled by the fetch loops", ("kind",))
+
+DECISION_LIKE = "like"
+DECISION_PASS = "pass"
+PICKUP_STATE_KEY = "pickup_progress"
+
+# Per-endpoint headers added on top of the auth headers
+PICKUP_HEADERS = {"x-client-data": "XbPVwbt9ro651,n2rVn1tyD069k,DJK6pat0XpVPn,WAjEdltM2eEKl,J70RlrtM2GVlB,1GyEaGtvGB6jB"}
+LIKE_HEADERS = {
+    "accept": "application/json, text/plain, */*",
+    "content-type": "application/json",
+    "platform": "desktop",
+    "platform-version": "2",
+    "x-client-version": "desktop-spa/69b81e654",
+    "priority": "u=1, i"
+}
+PROFILE_HEADERS = {"accept-version": "3.0", "cache-control": "no-cache"}
+
+def migrate_json_decisions(db, file_path, decision):
+    if not os.path.exists(file_path):
+        return
+    try:
+        with open(file_path, "r") as f:
+            hids = json.load(f)
+    except Exception as e:
+        logger.error(f"Error loading file {file_path}: {e}")
+        return
+    
+    imported = db.save_decisions_bulk(hids, decision)
+    if imported != len(hids):
+        logger.error(f"Imported only {imported}/{len(hids)} hids from {file_path}, keeping the file")
+        return
+    os.replace(file_path, f"{file_path}.migrated")
+    logger.info(f"Migrated {imported} {decision} decisions from {file_path}")
+
+def profile_hid(profile):
+    hid = profile.get("hid")
+    if not hid and isinstance(profile.get("user"), dict):
+        hid = profile["user"].get("hid")
+    return hid
+
+def should_retry(method, resp):
+    # Only GETs are safe to repeat after any retryable status; other
+    # requests only when the server asked to be retried later
+    if resp.status_code not in Config.HTTP_RETRY_STATUSES:
+        return False
+    if method.upper() == "GET":
+        return True
+    return resp.status_code in Config.HTTP_RETRY_AFTER_STATUSES and resp.headers.get("Retry-After") is not None
+
+def lease_owner(pid=None):
+    # Names a worker process in the profile_queue leases it holds
+    return f"{socket.gethostname()}:{pid or os.getpid()}"
+
+class RefreshScheduler:
+    # Hands out the stalest stored profiles for re-fetching, never more than
+    # Config.PROFILE_REFRESH_PER_HOUR per hour; unused allowance carries over
+    # up to one batch
+    def __init__(self, db, per_hour=None, max_age=None):
+        self.db = db
+        self.per_hour = Config.PROFILE_REFRESH_PER_HOUR if per_hour is None else per_hour
+        self.max_age = Config.PROFILE_REFRESH_AFTER if max_age is None else max_age
+        self._allowance = 0.0
+        self._updated = time.monotonic()
+
+    def next_batch(self, limit):
+        if not self.per_hour:
+            return []
+        now = time.monotonic()
+        self._allowance = min(limit, self._allowance + (now - self._updated) * self.per_hour / 3600)
+        self._updated = now
+        if self._allowance < 1:
+            return []
+        # Claimed rather than just read, so parallel workers refresh different profiles
+        hids = self.db.claim_stale_profiles(time.time() - self.max_age, int(self._allowance))
+        self._allowance -= len(hids)
+        return hids
+
 class KismiaAPI:
-    def __init__(self, auth_manager):
+    def __init__(self, auth_manager, db=None, transport=None, writer=None):
         self.auth_manager = auth_manager
-        self.cookies = HttpConfig.get_common_cookies()
-        self.db = Database()
+        self.transport = transport or getattr(auth_manager, "transport", None) or HttpTransport()
+        self.db = db or open_database()
+        # Writes go through a shared writer thread; without one, we own a private writer
+        self._owns_writer = writer is None
+        self.writer = writer or DatabaseWriter(self.db).start()
+        self.pacer = self.transport.pacer
         self.base_url = HttpConfig.BASE_URL
-        self.next_page_token = None
+        self._auth_headers = (None, None)
+        self.stop_event = threading.Event()
+        
+        # Pagination resumes from the last checkpointed page after a restart
+        self.progress = self.db.get_state(PICKUP_STATE_KEY) or {
+            "page_token": None, "pages": 0, "saved": 0, "liked": 0, "passed": 0, "skipped": 0
+        }
+        self.next_page_token = self.progress.get("page_token")
+        if self.next_page_token:
+            logger.info(f"Resuming pagination after page {self.progress['pages']}")
         
-        # Load user data files
-        self.passed_users_file = os.path.join(Config.DATA_DIR, "passed_users.json")
-        self.liked_users_file = os.path.join(Config.DATA_DIR, "liked_users.json")
-        self.passed_users = self._load_json_set(self.passed_users_file)
-        self.liked_users = self._load_json_set(self.liked_users_file)
+        # Decisions live in the decisions table; the old JSON files are imported once
+        self._migrate_json_set(os.path.join(Config.DATA_DIR, "passed_users.json"), DECISION_PASS)
+        self._migrate_json_set(os.path.join(Config.DATA_DIR, "liked_users.json"), DECISION_LIKE)
+        self.passed_users = self.db.get_decided_hids(DECISION_PASS)
+        self.liked_users = self.db.get_decided_hids(DECISION_LIKE)
         self.like_probability = 0.5
+        self.refresh = RefreshScheduler(self.db)
+        self.worker_id = lease_owner()
     
-    def _load_json_set(self, file_path):
-        if os.path.exists(file_path):
-            try:
-                with open(file_path, "r") as f:
-                    return set(json.load(f))
-            except Exception as e:
-                logger.error(f"Error loading file {file_path}: {e}")
-        return set()
+    def _migrate_json_set(self, file_path, decision):
+        migrate_json_decisions(self.db, file_path, decision)
     
-    def _save_json_set(self, data_set, file_path):
+    def stop(self):
+        # Loops finish the item in hand, then return; pauses end immediately
+        self.stop_event.set()
+        self.pacer.interrupt()
+    
+    def close(self):
+        if self._owns_writer:
+            self.writer.close()
+    
+    @staticmethod
+    def _write_result(future, default):
         try:
-            with open(file_path, "w") as f:
-                json.dump(list(data_set), f)
+            with STAGES.time("write_wait"):
+                return future.result()
         except Exception as e:
-            logger.error(f"Error saving file {file_path}: {e}")
+            logger.error(f"Database write failed: {e}")
+            return default
     
     def get_headers(self, additional_headers=None):
-        access_token = self.auth_manager.get_access_token()
+        with STAGES.time("headers"):
+            access_token = self.auth_manager.get_access_token()
         if not access_token:
             logger.error("Could not get a valid access token")
             return None
-            
-        headers = HttpConfig.get_common_headers(access_token)
-        headers["referer"] = f"{self.base_url}/matches"
+        
+        # Common headers and cookies are carried by the transport session;
+        # the auth headers are rebuilt only when the token changes.
+        cached_token, headers = self._auth_headers
+        if cached_token != access_token:
+            headers = {
+                "authorization": f"JWT {access_token}",
+                "referer": f"{self.base_url}/matches"
+            }
+            self._auth_headers = (access_token, headers)
         
         if additional_headers:
-            headers.update(additional_headers)
-            
+            return {**headers, **additional_headers}
         return headers
     
     def make_request(self, method, url, **kwargs):
-        if 'timeout' not in kwargs:
-            kwargs['timeout'] = Config.REQUEST_TIMEOUT
-            
+        # Pacing and backoff happen in the transport's pacer; this only decides
+        # whether a failed attempt is worth repeating.
         for attempt in range(Config.MAX_RETRIES):
             try:
-                return requests.request(method, url, **kwargs)
+                resp = self.transport.request(method, url, **kwargs)
             except requests.RequestException as e:
                 logger.warning(f"Request failed (attempt {attempt+1}/{Config.MAX_RETRIES}): {e}")
                 if attempt >= Config.MAX_RETRIES - 1:
                     logger.error(f"Max retries reached for request to {url}")
                     raise
-                time.sleep(Config.RETRY_DELAY)
+                continue
+            
+            if should_retry(method, resp) and attempt < Config.MAX_RETRIES - 1:
+                logger.warning(f"Request got status {resp.status_code} (attempt {attempt+1}/{Config.MAX_RETRIES}), retrying")
+                continue
+            return resp
     
     def pass_on_user(self, hid, tracking_data=None, operation_token=None):
         if hid in self.passed_users:
@@ -75,7 +190,7 @@ class KismiaAPI:
             return True
             
         self.passed_users.add(hid)
-        self._save_json_set(self.passed_users, self.passed_users_file)
+        self.writer.submit_decision(hid, DECISION_PASS)
         
         try:
             url = f"{self.base_url}/v3/matchesGame/users/{operation_token}:pass"
@@ -87,7 +202,7 @@ class KismiaAPI:
             if tracking_data:
                 json_data["trackingData"] = tracking_data
             
-            resp = self.make_request("POST", url, headers=headers, cookies=self.cookies, json=json_data)
+            resp = self.make_request("POST", url, headers=headers, json=json_data)
             logger.debug(f"Pass response for {hid}: status={resp.status_code}, body={resp.text[:200]}")
             
             if resp.status_code == 200:
@@ -108,14 +223,7 @@ class KismiaAPI:
         try:
             url = f"{self.base_url}/v3/matchesGame/users/{operation_token}:like"
             
-            headers = self.get_headers({
-                "accept": "application/json, text/plain, */*",
-                "content-type": "application/json",
-                "platform": "desktop",
-                "platform-version": "2",
-                "x-client-version": "desktop-spa/69b81e654",
-                "priority": "u=1, i"
-            })
+            headers = self.get_headers(LIKE_HEADERS)
             
             if not headers:
                 return False
@@ -124,12 +232,12 @@ class KismiaAPI:
             if tracking_data:
                 json_data["trackingData"] = tracking_data
             
-            resp = self.make_request("POST", url, headers=headers, cookies=self.cookies, json=json_data)
+            resp = self.make_request("POST", url, headers=headers, json=json_data)
             logger.debug(f"Like response for {hid}: status={resp.status_code}, body={resp.text[:200]}")
             
             if resp.status_code in [200, 400]:
                 self.liked_users.add(hid)
-                self._save_json_set(self.liked_users, self.liked_users_file)
+                self.writer.submit_decision(hid, DECISION_LIKE)
                 log_msg = "Successfully liked" if resp.status_code == 200 else "Like request sent to"
                 logger.info(f"{log_msg} user {hid}")
                 return True
@@ -147,27 +255,30 @@ class KismiaAPI:
         batch_url = f"{self.base_url}/v3/matchesGame/users:pickUp"
         
         for page in range(max_pages):
-            headers = self.get_headers({"x-client-data": "XbPVwbt9ro651,n2rVn1tyD069k,DJK6pat0XpVPn,WAjEdltM2eEKl,J70RlrtM2GVlB,1GyEaGtvGB6jB"})
+            if self.stop_event.is_set():
+                break
+            headers = self.get_headers(PICKUP_HEADERS)
             if not headers:
                 break
 
             url = batch_url if not self.next_page_token else f"{batch_url}?pageToken={self.next_page_token}"
             try:
-                resp = self.make_request("GET", url, headers=headers, cookies=self.cookies)
+                resp = self.make_request("GET", url, headers=headers)
                 if resp.status_code != 200:
                     logger.error(f"Request failed with status: {resp.status_code}")
                     break
 
-                data = resp.json()
+                with STAGES.time("json"):
+                    data = json_codec.loads(resp.content)
                 hits = data.get("hits", [])
                 logger.info(f"Fetched {len(hits)} users from batch API")
                 
                 stats = {"saved": 0, "passed": 0, "liked": 0, "skipped": 0}
+                saved = self.writer.submit_users(hits)
                 
                 for hit in hits:
-                    if self.db.save_user(hit):
-                        stats["saved"] += 1
-                    
+                    if self.stop_event.is_set():
+                        break
                     if 'user' in hit and 'hid' in hit['user']:
                         hid = hit['user']['hid']
                         tracking_data = hit.get('trackingData')
@@ -184,75 +295,141 @@ class KismiaAPI:
                             if self.pass_on_user(hid, tracking_data, operation_token):
                                 stats["passed"] += 1
                         
-                        time.sleep(random.uniform(0.5, 1.5))
+                        self.pacer.delay(Config.SWIPE_DELAY_MIN, Config.SWIPE_DELAY_MAX)
                     
+                stats["saved"], _ = self._write_result(saved, (0, 0))
+                for key, value in stats.items():
+                    ITEMS.inc(value, kind=f"users_{key}")
                 logger.info(f"\033[92mAdded {stats['saved']} new items\033[0m")
                 logger.info(f"Liked {stats['liked']}, passed on {stats['passed']}, skipped {stats['skipped']} out of {len(hits)} users")
+                if self.stop_event.is_set():
+                    # The page was cut short; its token is not checkpointed so it is redone
+                    break
                 logger.info(f"Page {page + 1} processed")
 
                 self.next_page_token = data.get("nextPageToken")
+                self._checkpoint_page(stats)
+                ITEMS.inc(kind="pages")
+                STAGES.count_items(len(hits))
                 if not self.next_page_token:
                     logger.info("No nextPageToken found; ending pagination")
                     break
             except Exception as e:
                 logger.error(f"Error fetching items: {e}")
-                time.sleep(Config.RETRY_DELAY)
+                self.pacer.delay(Config.RETRY_DELAY, Config.RETRY_DELAY)
                 continue
 
-            time.sleep(random.uniform(Config.HIDS_PAGE_DELAY_MIN, Config.HIDS_PAGE_DELAY_MAX))
+            self.pacer.delay(Config.HIDS_PAGE_DELAY_MIN, Config.HIDS_PAGE_DELAY_MAX)
         
-        total_users = self.db.count_users()
+        total_users, _ = self.db.progress_counts()
         logger.info(f"Total users in database: {total_users}")
         return total_users
     
-    def fetch_user_profile(self, hid):
+    def _checkpoint_page(self, stats):
+        self.progress["page_token"] = self.next_page_token
+        self.progress["pages"] += 1
+        for key, value in stats.items():
+            self.progress[key] = self.progress.get(key, 0) + value
+        self.writer.submit_state({PICKUP_STATE_KEY: self.progress})
+    
+    def fetch_user_profiles(self, hids):
         profile_url = f"{self.base_url}/rest/v2/user/info/profile"
-        headers = self.get_headers({
-            "accept-version": "3.0",
-            "cache-control": "no-cache"
-        })
+        headers = self.get_headers(PROFILE_HEADERS)
         if not headers:
             return None
 
-        params = {"data_group": "profile", "users_hids[]": hid}
+        params = {"data_group": "profile", "users_hids[]": list(hids)}
         
         try:
-            resp = self.make_request("GET", profile_url, headers=headers, cookies=self.cookies, params=params)
+            resp = self.make_request("GET", profile_url, headers=headers, params=params)
             if resp.status_code != 200:
-                logger.error(f"Profile fetch failed for hid {hid} with status: {resp.status_code}")
+                logger.error(f"Profile fetch failed for {len(hids)} hids with status: {resp.status_code}")
                 return None
                 
-            data = resp.json()
-            if "result" in data and data["result"]:
-                profile = data["result"][0]
-                logger.info(f"Fetched profile for hid {hid}")
-                return profile
-            else:
-                logger.warning(f"No profile data for hid {hid}")
+            with STAGES.time("json"):
+                data = json_codec.loads(resp.content)
+            results = data.get("result") or []
+            if len(hids) == 1 and len(results) == 1 and not profile_hid(results[0]):
+                return {hids[0]: results[0]}
+            
+            requested = set(hids)
+            profiles = {}
+            for profile in results:
+                hid = profile_hid(profile)
+                if hid in requested and profile:
+                    profiles[hid] = profile
+            logger.info(f"Fetched {len(profiles)}/{len(hids)} profiles")
+            return profiles
         except Exception as e:
-            logger.error(f"Exception while fetching profile for hid {hid}: {e}")
+            logger.error(f"Exception while fetching profiles for {len(hids)} hids: {e}")
         return None
     
+    def fetch_user_profile(self, hid):
+        profiles = self.fetch_user_profiles([hid])
+        if profiles is None:
+            return None
+        if hid not in profiles:
+            logger.warning(f"No profile data for hid {hid}")
+        return profiles.get(hid)
+    
     def process_profiles_batch(self, limit=50):
-        users = self.db.get_users_without_profile(limit=limit)
+        # New users first; only when none are waiting, refresh stale profiles.
+        # Claiming leases the batch, so other worker processes skip it.
+        hids = self.db.claim_profiles(self.worker_id, limit)
+        refreshing = not hids
+        if refreshing:
+            hids = self.refresh.next_batch(limit)
         processed_count = 0
+        batch_size = max(1, Config.PROFILE_BATCH_SIZE)
         
-        for hid, user_data in users:
-            profile = self.fetch_user_profile(hid)
-            if profile and self.db.save_user_profile(hid, profile):
-                processed_count += 1
+        writes = []
+        requeues = []
+        
+        for start in range(0, len(hids), batch_size):
+            if self.stop_event.is_set():
+                break
+            chunk = hids[start:start + batch_size]
+            profiles = self.fetch_user_profiles(chunk)
+            if profiles is not None:
+                writes.append(self.writer.submit_profiles(profiles.items()))
+                
+                # Hids the API silently left out go to the back of the queue
+                missing = [hid for hid in chunk if hid not in profiles]
+                ITEMS.inc(len(profiles), kind="profiles_fetched")
+                STAGES.count_items(len(profiles))
+                if missing:
+                    ITEMS.inc(len(missing), kind="profiles_missing")
+                    logger.warning(f"No profile data for {len(missing)} hids, requeueing")
+                    requeues.append(self.writer.submit_requeue(self.worker_id, missing))
             
-            time.sleep(random.uniform(Config.PROFILE_FETCH_DELAY_MIN, Config.PROFILE_FETCH_DELAY_MAX))
+            self.pacer.delay(Config.PROFILE_FETCH_DELAY_MIN, Config.PROFILE_FETCH_DELAY_MAX)
+        
+        # The next batch is picked from the queue, so it must see these writes;
+        # requeues also have to land before the leases below are released
+        for future in writes:
+            saved, _ = self._write_result(future, (0, 0))
+            processed_count += saved
+        for future in requeues:
+            self._write_result(future, 0)
+        if not refreshing:
+            # Hids that were not fetched (errors, shutdown) are free to claim again
+            self.db.complete_profiles(self.worker_id, hids)
         
+        if refreshing:
+            ITEMS.inc(processed_count, kind="profiles_refreshed")
+            if processed_count:
+                logger.info(f"Refreshed {processed_count} stale profiles")
+            return processed_count
+        ITEMS.inc(processed_count, kind="profiles_saved")
         logger.info(f"Processed {processed_count} new profiles")
-        total_with_profile = self.db.count_users_with_profile()
-        total_users = self.db.count_users()
+        total_users, total_with_profile = self.db.progress_counts()
         logger.info(f"Progress: {total_with_profile}/{total_users} profiles fetched")
         return processed_count
     
     def continuous_profile_fetch(self):
-        while True:
+        while not self.stop_event.is_set():
             processed = self.process_profiles_batch()
-            if processed == 0:
+            if processed == 0 and not self.stop_event.is_set():
                 logger.info("No new profiles to process, waiting...")
-                time.sleep(Config.PROFILE_POLL_INTERVAL) 
\ No newline at end of file
+                with STAGES.time("poll"):
+                    self.stop_event.wait(Config.PROFILE_POLL_INTERVAL) 
\ No newline at end of file
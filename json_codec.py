@@ -0,0 +1,52 @@
+import json
+from config import Config
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Preferred order when Config.JSON_BACKEND is not set; json always works
+BACKENDS = ("msgspec", "orjson", "json")
+
+def available_backends():
+    modules = {"msgspec": msgspec, "orjson": orjson, "json": json}
+    return [name for name in BACKENDS if modules[name] is not None]
+
+class JsonCodec:
+    # Every backend encodes to the same compact, non-ASCII-escaped text, so
+    # stored rows and their content hashes do not depend on which one wrote them
+    def __init__(self, backend=None):
+        available = available_backends()
+        self.backend = backend or available[0]
+        if self.backend not in available:
+            raise RuntimeError(f"JSON backend {self.backend} is not installed (available: {', '.join(available)})")
+        if self.backend == "msgspec":
+            self._decoder = msgspec.json.Decoder()
+            self._encoder = msgspec.json.Encoder()
+
+    def loads(self, data):
+        if self.backend == "msgspec":
+            try:
+                return self._decoder.decode(data)
+            except msgspec.DecodeError as e:
+                raise ValueError(str(e)) from e
+        if self.backend == "orjson":
+            return orjson.loads(data)
+        return json.loads(data)
+
+    def dumps(self, obj):
+        if self.backend == "msgspec":
+            return self._encoder.encode(obj).decode()
+        if self.backend == "orjson":
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+_default = JsonCodec(Config.JSON_BACKEND)
+loads = _default.loads
+dumps = _default.dumps
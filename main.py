@@ -1,8 +1,20 @@
+import argparse
+import asyncio
 import logging
+import multiprocessing
+import os
+import signal
 import threading
 from auth import AuthManager
-from fetcher import KismiaAPI
-from db import Database
+from fetcher import AsyncKismiaAPI, KismiaAPI
+from fetcher.kismia_api import lease_owner
+from sharding import open_database
+from pipeline import DatabaseWriter
+from pacer import SharedAsyncPacer, SharedPacer, shared_pacer_state
+from utils import HttpTransport
+from config import Config
+import metrics
+import profiling
 
 logging.basicConfig(
     level=logging.INFO,
@@ -10,25 +22,227 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+WORKER_LOG_FORMAT = '%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s'
+
 def main():
+    parser = argparse.ArgumentParser(description="Fetch users and profiles from Kismia")
+    parser.add_argument("--recount", action="store_true", help="recount the stats table from the users table before starting")
+    parser.add_argument("--engine", choices=("threads", "async"), default="threads", help="async needs aiohttp")
+    parser.add_argument("--pick-up", action="store_true", help="also run the pick-up pagination loop (likes and passes)")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="run the profile loop in this many processes sharing the database and one request pacer"
+    )
+    parser.add_argument(
+        "--profile", type=float, metavar="SECONDS", nargs="?", const=Config.PROFILE_DURATION,
+        help="sample every thread for this long after starting and write folded stacks to Config.PROFILE_DIR; "
+             "SIGUSR1 does the same on a running process"
+    )
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        supervise(args)
+        return
+
+    metrics_server, metrics_dumper = start_metrics()
     auth_manager = AuthManager()
-    db = Database()
-    api = KismiaAPI(auth_manager)
-    
-    logger.info(f"Starting with {db.count_users()} users in database")
-    logger.info(f"Users with profiles: {db.count_users_with_profile()}")
-    
-    # batch_thread = threading.Thread(target=api.fetch_batch_users, daemon=True)
-    profile_thread = threading.Thread(target=api.continuous_profile_fetch, daemon=True)
-
-    # batch_thread.start()
-    profile_thread.start()
-    
+    auth_manager.start_background_refresh()
+    db = open_database()
+    log_progress(db, args.recount)
+    if args.profile:
+        profiling.start_profile(args.profile)
+
+    try:
+        run_engine(args.engine, auth_manager, db, args.pick_up)
+    finally:
+        auth_manager.stop_background_refresh()
+        db.close()
+        profiling.stop_profile()
+        stop_metrics(metrics_server, metrics_dumper)
+        logger.info("Shutdown complete")
+
+def start_metrics(worker=None):
+    port, path = Config.METRICS_PORT, Config.METRICS_FILE
+    if worker is not None:
+        # Every worker process has its own registry, exposed next to the supervisor's
+        port = port and port + 1 + worker
+        if path:
+            base, ext = os.path.splitext(path)
+            path = f"{base}.worker{worker}{ext}"
+    server = metrics.start_http_server(port) if port else None
+    dumper = metrics.JsonDumper(path, Config.METRICS_DUMP_INTERVAL).start() if path else None
+    return server, dumper
+
+def stop_metrics(server, dumper):
+    if dumper:
+        dumper.stop()
+    if server:
+        server.shutdown()
+
+def log_progress(db, recount=False):
+    if recount:
+        logger.info("Recounting users; this scans the whole table")
+        db.recount()
+    total_users, total_with_profile = db.progress_counts()
+    logger.info(f"Starting with {total_users} users in database")
+    logger.info(f"Users with profiles: {total_with_profile}")
+
+def run_engine(engine, auth_manager, db, pick_up, pacer=None, workers=1):
+    if engine == "async":
+        asyncio.run(run_async(auth_manager, db, pick_up, pacer, workers))
+    else:
+        run_threads(auth_manager, db, pick_up, workers)
+
+def run_threads(auth_manager, db, pick_up, workers=1):
+    # One writer thread shared by every fetch loop
+    writer = DatabaseWriter(db).start()
+    api = KismiaAPI(auth_manager, db, writer=writer)
+    # Each worker process takes its share of the refresh budget
+    api.refresh.per_hour /= workers
+
+    def handle_signal(signum, frame):
+        logger.info(f"Received {signal.Signals(signum).name}; finishing current item and shutting down")
+        api.stop()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    if profiling.profile_signal():
+        signal.signal(profiling.profile_signal(), lambda signum, frame: profiling.start_profile())
+
+    threads = [threading.Thread(target=api.continuous_profile_fetch, daemon=True)]
+    if pick_up:
+        threads.append(threading.Thread(target=api.fetch_batch_users, daemon=True))
+    for thread in threads:
+        thread.start()
+
+    try:
+        # Joined with a timeout so the main thread keeps handling signals
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1)
+    finally:
+        api.stop()
+        writer.close()
+        api.transport.close()
+
+async def run_async(auth_manager, db, pick_up, pacer=None, workers=1):
+    async with AsyncKismiaAPI(auth_manager, db, pacer=pacer) as api:
+        api.refresh.per_hour /= workers
+
+        def handle_signal(signum):
+            logger.info(f"Received {signal.Signals(signum).name}; finishing current item and shutting down")
+            api.stop()
+
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, handle_signal, signum)
+        if profiling.profile_signal():
+            loop.add_signal_handler(profiling.profile_signal(), profiling.start_profile)
+        await api.run(pick_up=pick_up, profiles=True)
+
+def supervise(args):
+    # Runs args.workers worker processes against one database. Profile
+    # batches are leased from the queue, so workers never fetch the same
+    # hid; all requests go through one pacer in shared memory, so together
+    # the workers stay within Config.RATE_LIMIT_PER_SEC. The supervisor is
+    # the only process that refreshes tokens, restarts workers that crash
+    # and frees the leases they held.
+    context = multiprocessing.get_context("spawn")
+    shared_pacer = shared_pacer_state(context=context)
+    metrics_server, metrics_dumper = start_metrics()
+    auth_manager = AuthManager(HttpTransport(SharedPacer(shared_pacer)))
+    auth_manager.start_background_refresh()
+    db = open_database()
+    log_progress(db, args.recount)
+    released = db.reclaim_profiles()
+    if released:
+        logger.info(f"Released {released} expired profile leases")
+
+    stop_event = threading.Event()
+
+    def handle_signal(signum, frame):
+        logger.info(f"Received {signal.Signals(signum).name}; stopping workers")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    workers = {}
+
+    def forward_profile_signal(signum, frame):
+        # The work happens in the workers, so they are the ones profiled
+        for process in workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    if profiling.profile_signal():
+        signal.signal(profiling.profile_signal(), forward_profile_signal)
+
+    def spawn(index):
+        # Only the first worker paginates: pick-up progress is a single checkpoint
+        process = context.Process(
+            target=run_worker,
+            args=(index, args.workers, shared_pacer, args.engine, args.pick_up and index == 0, args.profile),
+            name=f"worker-{index}"
+        )
+        process.start()
+        workers[index] = process
+        logger.info(f"Started worker {index} (pid {process.pid})")
+
+    try:
+        for index in range(args.workers):
+            spawn(index)
+        while workers and not stop_event.is_set():
+            for index, process in list(workers.items()):
+                if process.is_alive():
+                    continue
+                released = db.reclaim_profiles(lease_owner(process.pid))
+                if process.exitcode == 0:
+                    logger.info(f"Worker {index} exited")
+                    del workers[index]
+                    continue
+                logger.warning(
+                    f"Worker {index} died with exit code {process.exitcode}; "
+                    f"released {released} leased profiles, restarting"
+                )
+                if not stop_event.wait(Config.RETRY_DELAY):
+                    spawn(index)
+            stop_event.wait(1)
+    finally:
+        for process in workers.values():
+            if process.is_alive():
+                # SIGTERM: the worker finishes its current item and flushes its writes
+                process.terminate()
+        for process in workers.values():
+            process.join(Config.WORKER_SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop in time; killing it")
+                process.kill()
+                process.join()
+            db.reclaim_profiles(lease_owner(process.pid))
+        auth_manager.stop_background_refresh()
+        db.close()
+        stop_metrics(metrics_server, metrics_dumper)
+        logger.info("Shutdown complete")
+
+def run_worker(index, workers, shared_pacer, engine, pick_up, profile=None):
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter(WORKER_LOG_FORMAT))
+    if profile:
+        profiling.start_profile(profile)
+    metrics_server, metrics_dumper = start_metrics(worker=index)
+    # Tokens are refreshed by the supervisor and picked up from the token file
+    auth_manager = AuthManager(HttpTransport(SharedPacer(shared_pacer)), refresh=False)
+    auth_manager.start_background_refresh()
+    db = open_database()
     try:
-        # batch_thread.join() only one at a time
-        profile_thread.join()
-    except KeyboardInterrupt:
-        logger.info("Process interrupted by user")
+        pacer = SharedAsyncPacer(shared_pacer) if engine == "async" else None
+        run_engine(engine, auth_manager, db, pick_up, pacer, workers)
+    finally:
+        auth_manager.stop_background_refresh()
+        db.close()
+        profiling.stop_profile()
+        stop_metrics(metrics_server, metrics_dumper)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,188 @@
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+import sys
+import json_codec
+from compression import train_dictionary
+from config import Config
+from sharding import open_database, shard_paths
+from snapshot import FORMATS, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+def export_users(args):
+    db = open_database(args.db, args.shards)
+    fields = [field for field in args.fields.split(",") if field] if args.fields else None
+    out = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    count = 0
+    try:
+        if args.format == "jsonl":
+            if fields:
+                for row in db.iter_users(batch_size=args.batch_size, fields=fields):
+                    out.write(json_codec.dumps(row) + "\n")
+                    count += 1
+            else:
+                # Splice the stored JSON text as-is instead of decoding and re-encoding it
+                for hid, data, profile in db.iter_users(batch_size=args.batch_size, raw=True):
+                    out.write(f'{{"hid":{json.dumps(hid)},"data":{data},"profile_detailed":{profile or "null"}}}\n')
+                    count += 1
+        else:
+            writer = csv.writer(out)
+            if fields:
+                writer.writerow(fields)
+                for row in db.iter_users(batch_size=args.batch_size, fields=fields):
+                    writer.writerow([
+                        json_codec.dumps(value) if isinstance(value, (dict, list)) else value
+                        for value in row.values()
+                    ])
+                    count += 1
+            else:
+                writer.writerow(["hid", "data", "profile_detailed"])
+                for row in db.iter_users(batch_size=args.batch_size, raw=True):
+                    writer.writerow(row)
+                    count += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        db.close()
+    logger.info(f"Exported {count} users")
+
+def compress_db(args):
+    db = open_database(args.db, args.shards)
+    try:
+        algorithm = None if args.algorithm == "none" else args.algorithm
+        dictionary = None
+        if algorithm and args.sample > 0:
+            samples = []
+            for _, data, profile in db.iter_users(raw=True):
+                samples.append(data)
+                if profile:
+                    samples.append(profile)
+                if len(samples) >= args.sample:
+                    break
+            dictionary = train_dictionary(algorithm, samples, args.dict_size)
+            if dictionary:
+                logger.info(f"Trained a {len(dictionary)} byte {algorithm} dictionary on {len(samples)} samples")
+        db.set_compression(algorithm, dictionary)
+        rewritten = db.recompress(batch_size=args.batch_size)
+        logger.info(f"Rewrote {rewritten} rows with {algorithm or 'no'} compression")
+        if args.vacuum:
+            logger.info("Vacuuming database")
+            db.vacuum()
+    finally:
+        db.close()
+    if algorithm != Config.DB_COMPRESSION:
+        logger.warning(f"Set Config.DB_COMPRESSION = {algorithm!r} so new rows are written the same way")
+
+def index_attrs(args):
+    db = open_database(args.db, args.shards)
+    try:
+        rebuilt = db.rebuild_user_attrs(batch_size=args.batch_size)
+        logger.info(f"Indexed attributes of {rebuilt} users")
+    finally:
+        db.close()
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def reshard(args):
+    source = open_database(args.db, args.shards)
+    target_path = args.target or source.db_path
+    target_files = [target_path] if args.to == 1 else shard_paths(target_path, args.to)
+    existing = [path for path in target_files if os.path.exists(path)]
+    if existing:
+        source.close()
+        logger.error(f"Refusing to overwrite existing database files: {', '.join(existing)}")
+        sys.exit(1)
+
+    target = open_database(target_path, args.to)
+    try:
+        copied = 0
+        for batch in _batches(source._iter_rows(batch_size=args.batch_size, fetch_state=True), args.batch_size):
+            copied += target.import_users(batch)
+            logger.info(f"Copied {copied} users")
+        decisions = sum(
+            target.import_decisions(batch)
+            for batch in _batches(source.iter_decisions(batch_size=args.batch_size), args.batch_size)
+        )
+        for key, value in source.get_all_state().items():
+            target.set_state(key, value)
+        logger.info(f"Copied {copied} users and {decisions} decisions into {len(target_files)} file(s)")
+    finally:
+        target.close()
+        source.close()
+    logger.warning(
+        f"Set Config.DB_SHARDS = {args.to}"
+        + (f" and Config.DB_FILE = {target_path!r}" if target_path != Config.DB_FILE else "")
+        + " to use the new layout; the old files were left in place"
+    )
+
+def snapshot(args):
+    db = open_database(args.db, args.shards)
+    try:
+        written = write_snapshot(
+            db, args.output, fmt=args.format, full=args.full,
+            batch_size=args.batch_size, part_rows=args.part_rows
+        )
+        logger.info(f"Wrote {written} rows to the snapshot in {args.output}")
+    except RuntimeError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    finally:
+        db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Kismia database maintenance commands")
+    parser.add_argument("--db", help="database file (defaults to Config.DB_FILE)")
+    parser.add_argument("--shards", type=int, default=Config.DB_SHARDS, help="shard count of --db (defaults to Config.DB_SHARDS)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export = subparsers.add_parser("export", help="stream users to JSONL or CSV")
+    export.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    export.add_argument("--fields", help="comma-separated dotted JSON paths, e.g. user.hid,profile_detailed.age")
+    export.add_argument("--output", "-o", help="output file (defaults to stdout)")
+    export.add_argument("--batch-size", type=int, default=1000)
+    export.set_defaults(func=export_users)
+
+    compress = subparsers.add_parser("compress", help="rewrite stored JSON with a compression codec, in place")
+    compress.add_argument("--algorithm", choices=["zlib", "zstd", "none"], default="zlib")
+    compress.add_argument("--sample", type=int, default=2000, help="rows to train the dictionary on (0 disables it)")
+    compress.add_argument("--dict-size", type=int, default=Config.DB_COMPRESSION_DICT_SIZE)
+    compress.add_argument("--batch-size", type=int, default=1000)
+    compress.add_argument("--vacuum", action="store_true", help="reclaim the freed pages afterwards")
+    compress.set_defaults(func=compress_db)
+
+    attrs = subparsers.add_parser("index-attrs", help="(re)fill the user_attrs columns from the stored JSON")
+    attrs.add_argument("--batch-size", type=int, default=1000)
+    attrs.set_defaults(func=index_attrs)
+
+    resharding = subparsers.add_parser("reshard", help="copy the database into a layout with a different shard count")
+    resharding.add_argument("--to", type=int, required=True, help="new shard count (1 for a single file)")
+    resharding.add_argument("--target", help="base path of the new files (defaults to --db)")
+    resharding.add_argument("--batch-size", type=int, default=1000)
+    resharding.set_defaults(func=reshard)
+
+    snapshotting = subparsers.add_parser(
+        "snapshot", help="write Config.SNAPSHOT_COLUMNS as typed columns (Parquet, or .npz without pyarrow); "
+                         "later runs append only new and changed rows"
+    )
+    snapshotting.add_argument("--output", "-o", default=Config.SNAPSHOT_DIR, help="snapshot directory")
+    snapshotting.add_argument("--format", choices=("auto",) + FORMATS, default="auto")
+    snapshotting.add_argument("--full", action="store_true", help="discard the existing snapshot and write it again")
+    snapshotting.add_argument("--batch-size", type=int, default=1000)
+    snapshotting.add_argument("--part-rows", type=int, default=Config.SNAPSHOT_PART_ROWS, help="rows per part file")
+    snapshotting.set_defaults(func=snapshot)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
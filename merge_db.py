@@ -1,41 +1,217 @@
+import argparse
+import os
 import sqlite3
 import logging
+import time
+from config import Config
+from db import Database
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
-def merge_databases():
-    source_conn = sqlite3.connect('kismia_to_merge.db')
-    target_conn = sqlite3.connect('kismia.db')
-    
-    source_cursor = source_conn.cursor()
-    target_cursor = target_conn.cursor()
-    
+POLICIES = ("keep-target", "fill-profile", "prefer-newer")
+
+# Rows of the current chunk: src.users with hid in (?, ?]. The statements
+# that write users return the hids they touched, whose user_attrs are
+# then rebuilt.
+INSERT_NEW = '''
+INSERT OR IGNORE INTO main.users (hid, data, profile_detailed)
+SELECT hid, data, profile_detailed FROM src.users
+WHERE hid > ? AND hid <= ?
+RETURNING hid
+'''
+
+FILL_PROFILE = '''
+UPDATE main.users
+SET profile_detailed = (SELECT s.profile_detailed FROM src.users s WHERE s.hid = main.users.hid)
+WHERE hid > ? AND hid <= ? AND profile_detailed IS NULL
+AND EXISTS (
+    SELECT 1 FROM src.users s
+    WHERE s.hid = main.users.hid AND s.profile_detailed IS NOT NULL
+)
+RETURNING hid
+'''
+
+# Sources written before fetch_state existed carry no timestamps; their
+# copy is taken as the newer one
+PREFER_SOURCE = '''
+UPDATE main.users
+SET data = (SELECT s.data FROM src.users s WHERE s.hid = main.users.hid),
+    profile_detailed = COALESCE(
+        (SELECT s.profile_detailed FROM src.users s WHERE s.hid = main.users.hid),
+        profile_detailed
+    )
+WHERE hid > ? AND hid <= ?
+AND EXISTS (SELECT 1 FROM src.users s WHERE s.hid = main.users.hid)
+RETURNING hid
+'''
+
+# Each of data and profile_detailed comes from whichever side fetched it
+# last; unknown fetch times lose to known ones
+PREFER_NEWER = '''
+UPDATE main.users AS u
+SET data = CASE WHEN f.data_fetched_at > COALESCE(m.data_fetched_at, -1) THEN s.data ELSE u.data END,
+    profile_detailed = CASE
+        WHEN s.profile_detailed IS NOT NULL AND f.profile_fetched_at > COALESCE(m.profile_fetched_at, -1)
+        THEN s.profile_detailed ELSE u.profile_detailed
+    END
+FROM src.users s
+JOIN src.fetch_state f ON f.hid = s.hid
+LEFT JOIN main.fetch_state m ON m.hid = s.hid
+WHERE s.hid = u.hid AND u.hid > ? AND u.hid <= ?
+AND (
+    f.data_fetched_at > COALESCE(m.data_fetched_at, -1)
+    OR (s.profile_detailed IS NOT NULL AND f.profile_fetched_at > COALESCE(m.profile_fetched_at, -1))
+)
+RETURNING hid
+'''
+
+# After PREFER_NEWER: the fetch state follows the copy that won
+NEWER_FETCH_STATE = '''
+INSERT INTO main.fetch_state (hid, data_hash, data_fetched_at, profile_hash, profile_fetched_at)
+SELECT hid, data_hash, data_fetched_at, profile_hash, profile_fetched_at FROM src.fetch_state
+WHERE hid > ? AND hid <= ?
+ON CONFLICT(hid) DO UPDATE SET
+    data_hash = CASE WHEN excluded.data_fetched_at > COALESCE(data_fetched_at, -1) THEN excluded.data_hash ELSE data_hash END,
+    data_fetched_at = NULLIF(MAX(COALESCE(data_fetched_at, -1), COALESCE(excluded.data_fetched_at, -1)), -1),
+    profile_hash = CASE WHEN excluded.profile_fetched_at > COALESCE(profile_fetched_at, -1) THEN excluded.profile_hash ELSE profile_hash END,
+    profile_fetched_at = NULLIF(MAX(COALESCE(profile_fetched_at, -1), COALESCE(excluded.profile_fetched_at, -1)), -1)
+'''
+
+# New rows bring their fetch state; profiles filled in by fill-profile bring theirs
+COPY_FETCH_STATE = '''
+INSERT OR IGNORE INTO main.fetch_state (hid, data_hash, data_fetched_at, profile_hash, profile_fetched_at)
+SELECT hid, data_hash, data_fetched_at, profile_hash, profile_fetched_at FROM src.fetch_state
+WHERE hid > ? AND hid <= ?
+'''
+
+FILL_FETCH_STATE = '''
+UPDATE main.fetch_state
+SET profile_hash = (SELECT f.profile_hash FROM src.fetch_state f WHERE f.hid = main.fetch_state.hid),
+    profile_fetched_at = (SELECT f.profile_fetched_at FROM src.fetch_state f WHERE f.hid = main.fetch_state.hid)
+WHERE hid > ? AND hid <= ? AND profile_fetched_at IS NULL
+AND EXISTS (SELECT 1 FROM main.users u WHERE u.hid = main.fetch_state.hid AND u.profile_detailed IS NOT NULL)
+AND EXISTS (SELECT 1 FROM src.fetch_state f WHERE f.hid = main.fetch_state.hid)
+'''
+
+# Whatever is still without fetch state (sources without the table) gets
+# the same defaults as a migrated database
+DEFAULT_FETCH_STATE = '''
+INSERT OR IGNORE INTO main.fetch_state (hid, profile_fetched_at)
+SELECT hid, CASE WHEN profile_detailed IS NOT NULL THEN 0 END FROM main.users
+WHERE hid > ? AND hid <= ?
+'''
+
+def returned_hids(cursor):
+    return [row[0] for row in cursor]
+
+def merge_source(conn, db, source_path, policy, chunk_size):
+    # db is the target's Database, used to decode rows and index their attributes
+    conn.execute("ATTACH DATABASE ? AS src", (source_path,))
+    try:
+        # Compressed rows reference their dictionary by a content-derived id,
+        # so the source dictionaries are copied over before the rows
+        has_dicts = conn.execute(
+            "SELECT 1 FROM src.sqlite_master WHERE type = 'table' AND name = 'codec_dicts'"
+        ).fetchone()
+        if has_dicts:
+            conn.execute("INSERT OR IGNORE INTO main.codec_dicts SELECT id, algorithm, dictionary, created_at FROM src.codec_dicts")
+            db._load_codec(conn, Config.DB_COMPRESSION)
+        has_fetch_state = conn.execute(
+            "SELECT 1 FROM src.sqlite_master WHERE type = 'table' AND name = 'fetch_state'"
+        ).fetchone()
+
+        total = conn.execute("SELECT COUNT(*) FROM src.users").fetchone()[0]
+        logging.info(f"Merging {total} users from {source_path} (policy: {policy})")
+
+        last_hid = ""
+        processed = inserted = updated = 0
+        started = time.time()
+        while True:
+            upper, count = conn.execute(
+                "SELECT MAX(hid), COUNT(*) FROM (SELECT hid FROM src.users WHERE hid > ? ORDER BY hid LIMIT ?)",
+                (last_hid, chunk_size)
+            ).fetchone()
+            if not count:
+                break
+
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                chunk = (last_hid, upper)
+                changed = []
+                if policy == "fill-profile":
+                    changed = returned_hids(conn.execute(FILL_PROFILE, chunk))
+                    if has_fetch_state:
+                        conn.execute(FILL_FETCH_STATE, chunk)
+                elif policy == "prefer-newer" and has_fetch_state:
+                    changed = returned_hids(conn.execute(PREFER_NEWER, chunk))
+                    conn.execute(NEWER_FETCH_STATE, chunk)
+                elif policy == "prefer-newer":
+                    changed = returned_hids(conn.execute(PREFER_SOURCE, chunk))
+                new = returned_hids(conn.execute(INSERT_NEW, chunk))
+                if has_fetch_state:
+                    conn.execute(COPY_FETCH_STATE, chunk)
+                conn.execute(DEFAULT_FETCH_STATE, chunk)
+                # Rows written here bypass Database, so their attributes are indexed by hand
+                db._index_user_attrs(conn, changed + new)
+                updated += len(changed)
+                inserted += len(new)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+            processed += count
+            last_hid = upper
+            rate = processed / max(time.time() - started, 1e-9)
+            logging.info(f"{processed}/{total} rows ({processed * 100 // max(total, 1)}%), {inserted} inserted, {updated} updated, {rate:.0f} rows/s")
+
+        return inserted, updated
+    finally:
+        conn.execute("DETACH DATABASE src")
+
+def merge_databases(sources, target=None, policy="keep-target", chunk_size=10000):
+    target = target or Config.DB_FILE
+    # Creates the target schema (queue table, triggers) if it does not exist yet
+    db = Database(target)
+
+    conn = sqlite3.connect(target, timeout=Config.DB_BUSY_TIMEOUT, isolation_level=None)
+    conn.execute(f"PRAGMA journal_mode={Config.DB_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous={Config.DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size={int(Config.DB_CACHE_SIZE)}")
+
+    total_inserted = total_updated = 0
     try:
-        source_cursor.execute("SELECT hid, data, profile_detailed FROM users")
-        source_users = source_cursor.fetchall()
-        
-        target_cursor.execute("SELECT hid FROM users")
-        existing_hids = {row[0] for row in target_cursor.fetchall()}
-        
-        new_users = [user for user in source_users if user[0] not in existing_hids]
-        
-        if new_users:
-            logging.info(f"Adding {len(new_users)} new users to kismia.db")
-            target_cursor.executemany(
-                "INSERT INTO users (hid, data, profile_detailed) VALUES (?, ?, ?)",
-                new_users
-            )
-            target_conn.commit()
-            logging.info("Merge completed successfully")
-        else:
-            logging.info("No new users to add")
-            
-    except Exception as e:
-        logging.error(f"Error during merge: {e}")
-        target_conn.rollback()
+        for source in sources:
+            if not os.path.exists(source):
+                logging.error(f"Source database {source} not found, skipping")
+                continue
+            try:
+                inserted, updated = merge_source(conn, db, source, policy, chunk_size)
+            except Exception as e:
+                logging.error(f"Error merging {source}: {e}")
+                continue
+            total_inserted += inserted
+            total_updated += updated
+            logging.info(f"Merged {source}: {inserted} new users, {updated} updated")
     finally:
-        source_conn.close()
-        target_conn.close()
+        conn.close()
+        db.close()
+
+    logging.info(f"Merge completed: {total_inserted} new users, {total_updated} updated in {target}")
+    return total_inserted, total_updated
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge Kismia user databases into one")
+    parser.add_argument("sources", nargs="*", default=["kismia_to_merge.db"], help="source database files")
+    parser.add_argument("--target", default=Config.DB_FILE, help="target database file")
+    parser.add_argument(
+        "--policy", choices=POLICIES, default="keep-target",
+        help="keep-target: only add new users; fill-profile: also copy profiles the target lacks; "
+             "prefer-newer: take data and profile from whichever copy was fetched last"
+    )
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    args = parser.parse_args()
+    merge_databases(args.sources, args.target, args.policy, args.chunk_size)
 
 if __name__ == "__main__":
-    merge_databases() 
\ No newline at end of file
+    main()
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import multiprocessing
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from config import Config
+from metrics import REGISTRY
+from profiling import STAGES
+
+logger = logging.getLogger(__name__)
+
+PACER_SLOWDOWN = REGISTRY.gauge("kismia_pacer_slowdown", "Current adaptive slowdown factor of the request pacer")
+PACER_PUSHBACKS = REGISTRY.counter("kismia_pacer_pushbacks_total", "Responses that made the pacer back off")
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class Pacer:
+    # Shared by every request in the process. A token bucket caps the request
+    # rate at Config.RATE_LIMIT_PER_SEC; throttling or server errors multiply
+    # `slowdown`, which stretches both the bucket and the deliberate pauses,
+    # and it decays back to 1 as successful responses come in.
+    def __init__(self, rate=None, burst=None):
+        self.rate = Config.RATE_LIMIT_PER_SEC if rate is None else rate
+        self.burst = burst or Config.RATE_LIMIT_BURST
+        self._lock = threading.Lock()
+        self._init_state()
+        self._interrupted = threading.Event()
+
+    def _init_state(self):
+        self.slowdown = 1.0
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            self._interrupted.wait(seconds)
+
+    def interrupt(self):
+        # Wakes every sleeper and turns later pauses into no-ops so the fetch
+        # loops can reach their stop checks during shutdown
+        self._interrupted.set()
+
+    def _reserve(self):
+        # Takes a token and returns 0, or returns how long to wait before trying again
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if not self.rate:
+                return 0
+            rate = self.rate / self.slowdown
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / rate
+
+    def acquire(self):
+        start = None
+        while not self._interrupted.is_set():
+            wait = self._reserve()
+            if not wait:
+                break
+            start = start or time.perf_counter()
+            self._sleep(wait)
+        if start:
+            STAGES.add("rate_limit", time.perf_counter() - start)
+
+    def record(self, status, retry_after=None):
+        # status is None when the request failed before any response arrived
+        with self._lock:
+            if status is None or status in Config.HTTP_RETRY_STATUSES:
+                self.slowdown = min(self.slowdown * Config.PACER_BACKOFF_FACTOR, Config.PACER_MAX_SLOWDOWN)
+                pause = parse_retry_after(retry_after)
+                if pause is None:
+                    pause = Config.RETRY_DELAY * self.slowdown
+                now = time.monotonic()
+                self._blocked_until = max(self._blocked_until, now + pause)
+                self._tokens = 0.0
+                self._updated = max(now, self._blocked_until)
+                PACER_PUSHBACKS.inc()
+                PACER_SLOWDOWN.set(self.slowdown)
+                logger.warning(f"Server pushback ({status or 'no response'}); pausing {pause:.1f}s, slowdown x{self.slowdown:.1f}")
+            elif status < 400 and self.slowdown > 1.0:
+                self.slowdown = max(1.0, self.slowdown * Config.PACER_RECOVERY_FACTOR)
+                PACER_SLOWDOWN.set(self.slowdown)
+                if self.slowdown == 1.0:
+                    logger.info("Server healthy again; back to the baseline rate")
+
+    def delay(self, low, high):
+        # Deliberate politeness pause, stretched while the server is pushing back
+        with STAGES.time("sleep"):
+            self._sleep(random.uniform(low, high) * self.slowdown)
+
+class AsyncPacer(Pacer):
+    # The same bucket and backoff for the asyncio engine; waits yield to the
+    # event loop instead of blocking a thread
+    def __init__(self, rate=None, burst=None):
+        super().__init__(rate, burst)
+        self._loop = None
+        self._wakeup = None
+
+    def _async_event(self):
+        if self._wakeup is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            if self._interrupted.is_set():
+                self._wakeup.set()
+        return self._wakeup
+
+    async def _sleep_async(self, seconds):
+        if seconds <= 0:
+            # Still yield, or a loop with nothing to do starves the others
+            await asyncio.sleep(0)
+            return
+        try:
+            await asyncio.wait_for(self._async_event().wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def interrupt(self):
+        super().interrupt()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def acquire(self):
+        start = None
+        while not self._interrupted.is_set():
+            wait = self._reserve()
+            if not wait:
+                break
+            start = start or time.perf_counter()
+            await self._sleep_async(wait)
+        if start:
+            STAGES.add("rate_limit", time.perf_counter() - start)
+
+    async def delay(self, low, high):
+        with STAGES.time("sleep"):
+            await self._sleep_async(random.uniform(low, high) * self.slowdown)
+
+    async def sleep(self, seconds):
+        await self._sleep_async(seconds)
+
+def shared_pacer_state(burst=None, context=multiprocessing):
+    # Bucket and backoff state for SharedPacer/SharedAsyncPacer, created once
+    # by the supervisor and passed to every worker process it starts from
+    # the same multiprocessing context
+    burst = burst or Config.RATE_LIMIT_BURST
+    state = context.RawArray("d", [1.0, float(burst), time.monotonic(), 0.0])
+    return state, context.Lock()
+
+def _shared_field(index):
+    def get(self):
+        return self._shared[index]
+
+    def set(self, value):
+        self._shared[index] = value
+    return property(get, set)
+
+class _SharedBucket:
+    # Keeps slowdown, tokens and the pushback pause in shared memory behind a
+    # process-shared lock, so the workers together stay within
+    # Config.RATE_LIMIT_PER_SEC and back off together. time.monotonic() is
+    # system-wide, so the timestamps mean the same in every process.
+    slowdown = _shared_field(0)
+    _tokens = _shared_field(1)
+    _updated = _shared_field(2)
+    _blocked_until = _shared_field(3)
+
+    def __init__(self, shared, rate=None, burst=None):
+        self._shared, lock = shared
+        super().__init__(rate, burst)
+        self._lock = lock
+
+    def _init_state(self):
+        # Initialized once by shared_pacer_state, not by every worker
+        pass
+
+class SharedPacer(_SharedBucket, Pacer):
+    pass
+
+class SharedAsyncPacer(_SharedBucket, AsyncPacer):
+    pass
@@ -0,0 +1,108 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from config import Config
+from metrics import REGISTRY
+from profiling import STAGES
+
+logger = logging.getLogger(__name__)
+
+WRITER_QUEUE_DEPTH = REGISTRY.gauge("kismia_writer_queue_depth", "Writes waiting for the writer thread")
+WRITER_BATCH = REGISTRY.histogram(
+    "kismia_writer_batch_size", "Writes group-committed per transaction",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200)
+)
+
+class DatabaseWriter:
+    # Single thread that owns all database writes. Fetchers hand their parsed
+    # results to a bounded queue and move on to the next request; a full
+    # queue blocks them (back-pressure) instead of growing without bound.
+    _STOP = object()
+
+    def __init__(self, db, max_queue=None, batch_size=None):
+        self.db = db
+        self.batch_size = batch_size or Config.WRITER_BATCH_SIZE
+        self.queue = queue.Queue(maxsize=max_queue or Config.WRITER_QUEUE_SIZE)
+        self._thread = None
+        self._closed = False
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, kind, payload):
+        if self._closed:
+            raise RuntimeError("DatabaseWriter is closed")
+        future = Future()
+        # Blocks while the queue is full, which shows up as write_wait
+        with STAGES.time("write_wait"):
+            self.queue.put((kind, payload, future))
+        WRITER_QUEUE_DEPTH.set(self.queue.qsize())
+        return future
+
+    def submit_users(self, hits):
+        return self.submit("users", list(hits))
+
+    def submit_profiles(self, profiles):
+        return self.submit("profiles", list(profiles))
+
+    def submit_decision(self, hid, decision):
+        return self.submit("decisions", ([hid], decision))
+
+    def submit_requeue(self, owner, hids):
+        return self.submit("requeue", (list(hids), owner))
+
+    def submit_state(self, values):
+        return self.submit("state", dict(values))
+
+    def close(self):
+        # Everything queued before close() is still written
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            self.queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            # Group commit whatever else is already waiting
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self._STOP in batch:
+                stopping = True
+                batch = [item for item in batch if item is not self._STOP]
+            WRITER_QUEUE_DEPTH.set(self.queue.qsize())
+            if batch:
+                self._write(batch)
+
+        # Writes that raced with close() and landed behind the stop marker
+        leftovers = []
+        while True:
+            try:
+                leftovers.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if leftovers:
+            self._write(leftovers)
+
+    def _write(self, batch):
+        WRITER_BATCH.observe(len(batch))
+        try:
+            results = self.db.write_batch([(kind, payload) for kind, payload, _ in batch])
+        except Exception as e:
+            logger.error(f"Error writing batch of {len(batch)}: {e}")
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
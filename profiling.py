@@ -0,0 +1,204 @@
+import collections
+import logging
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from config import Config
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+STAGE_SECONDS = REGISTRY.counter("kismia_stage_seconds_total", "Time spent in each stage of the fetch loops", ("stage",))
+
+# Deliberate pauses and waits for the rate limiter; reported apart from real work
+IDLE_STAGES = ("sleep", "rate_limit", "poll")
+
+class StageTimer:
+    # Accumulates the time the fetch loops spend per stage (network, headers,
+    # json, write_<kind>, commit, ...) and logs a summary every `report_every`
+    # items. Stages are timed in whichever thread runs them, so the totals of
+    # concurrent loops can add up to more than the wall time.
+    def __init__(self, report_every=None):
+        self.report_every = Config.STAGE_REPORT_EVERY if report_every is None else report_every
+        self._lock = threading.Lock()
+        self._reset(time.monotonic())
+
+    def _reset(self, now):
+        self._totals = collections.defaultdict(float)
+        self._calls = collections.Counter()
+        self._items = 0
+        self._started = now
+
+    def add(self, stage, seconds):
+        STAGE_SECONDS.inc(seconds, stage=stage)
+        with self._lock:
+            self._totals[stage] += seconds
+            self._calls[stage] += 1
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def count_items(self, count=1):
+        if not count:
+            return
+        with self._lock:
+            self._items += count
+            if not self.report_every or self._items < self.report_every:
+                return
+            summary = self._summary(time.monotonic())
+        logger.info(summary)
+
+    def summary(self):
+        # The summary of the current window, or None before the first item
+        with self._lock:
+            return self._summary(time.monotonic()) if self._items else None
+
+    def _summary(self, now):
+        # Formats the current window and starts a new one
+        items = max(self._items, 1)
+
+        def describe(stages):
+            return ", ".join(
+                f"{stage} {self._totals[stage]:.2f}s ({self._totals[stage] / items * 1000:.1f} ms/item, {self._calls[stage]} calls)"
+                for stage in sorted(stages, key=self._totals.get, reverse=True)
+            ) or "none"
+
+        work = [stage for stage in self._totals if stage not in IDLE_STAGES]
+        idle = [stage for stage in self._totals if stage in IDLE_STAGES]
+        summary = (
+            f"Stage times for {self._items} items over {now - self._started:.1f}s: "
+            f"work: {describe(work)}; waiting: {describe(idle)}"
+        )
+        self._reset(now)
+        return summary
+
+STAGES = StageTimer()
+
+class SamplingProfiler:
+    # Samples the stack of every thread each `interval` seconds for
+    # `duration` seconds and writes them as folded stacks ("thread;outer;...;
+    # inner count" lines), the input format of flamegraph.pl and speedscope.
+    # Runs in its own thread, so it can be started on a live process.
+    def __init__(self, duration=None, interval=None, directory=None):
+        self.duration = duration or Config.PROFILE_DURATION
+        self.interval = interval or Config.PROFILE_SAMPLE_INTERVAL
+        self.directory = directory or Config.PROFILE_DIR
+        self.path = None
+        self.samples = 0
+        self._stacks = collections.Counter()
+        self._idle = set()
+        self._labels = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # Ends the window early; the samples taken so far are still written
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _sample(self, own_ident):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            # A thread parked on a lock or condition; left out of top()
+            idle = frame.f_code.co_filename == threading.__file__
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            folded = ";".join(reversed(stack))
+            self._stacks[folded] += 1
+            if idle:
+                self._idle.add(folded)
+        self.samples += 1
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        deadline = time.monotonic() + self.duration
+        logger.info(f"Profiling every thread for {self.duration:.0f}s")
+        while not self._stop_event.is_set() and time.monotonic() < deadline:
+            self._sample(own_ident)
+            self._stop_event.wait(self.interval)
+        try:
+            self.path = self._write()
+        except OSError as e:
+            logger.error(f"Error writing profile: {e}")
+            return
+        logger.info(f"Wrote {self.samples} samples to {self.path}; busiest frames: {self.top()}")
+
+    def _write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+        path = os.path.join(self.directory, name)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(tmp_path, path)
+        return path
+
+    def top(self, limit=5):
+        # Innermost frames by share of the samples of threads that were not
+        # parked in a threading wait (the file still has those)
+        leaves = collections.Counter()
+        for stack, count in self._stacks.items():
+            if stack not in self._idle:
+                leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        return ", ".join(f"{label} {count / total:.0%}" for label, count in leaves.most_common(limit)) or "every thread was waiting"
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+def start_profile(duration=None):
+    # Starts a profiling window unless one is already running; safe to call
+    # from a signal handler
+    global _profiler
+    if not _profiler_lock.acquire(blocking=False):
+        return None
+    try:
+        if _profiler is not None and _profiler.is_running():
+            logger.info("A profile is already being taken; ignoring the request")
+            return None
+        summary = STAGES.summary()
+        if summary:
+            logger.info(summary)
+        _profiler = SamplingProfiler(duration).start()
+        return _profiler
+    finally:
+        _profiler_lock.release()
+
+def stop_profile():
+    # Ends a running profile early and writes what it has; called on shutdown
+    if _profiler is not None and _profiler.is_running():
+        _profiler.stop()
+
+def profile_signal():
+    # SIGUSR1 where the platform has it
+    return getattr(signal, "SIGUSR1", None)
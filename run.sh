@@ -0,0 +1,17 @@
+#!/bin/bash
+# Keeps main.py running. It checkpoints its progress and exits cleanly on
+# SIGTERM/SIGINT, so it is only restarted when it actually crashes.
+
+delay=30  # seconds to wait before restarting after a crash
+
+while true; do
+  echo "Starting script at $(date)"
+  python3 main.py "$@"
+  status=$?
+  if [ $status -eq 0 ]; then
+    echo "Script exited cleanly at $(date)"
+    break
+  fi
+  echo "Script exited with status $status, restarting in $delay seconds..."
+  sleep $delay
+done
@@ -0,0 +1,269 @@
+import heapq
+import itertools
+import logging
+import os
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from db import DB_USERS, Database, WRITE_FAILED, format_user_rows
+
+logger = logging.getLogger(__name__)
+
+LAYOUT_STATE_KEY = "shard_layout"
+
+def shard_index(hid, shards):
+    # crc32 rather than hash(): it must not change between processes
+    return zlib.crc32(hid.encode("utf-8")) % shards
+
+def shard_paths(db_path, shards):
+    base, ext = os.path.splitext(db_path)
+    return [f"{base}-shard{i}of{shards}{ext or '.db'}" for i in range(shards)]
+
+def open_database(db_path=None, shards=None):
+    shards = Config.DB_SHARDS if shards is None else shards
+    if shards > 1:
+        return ShardedDatabase(db_path, shards)
+    return Database(db_path)
+
+def _hit_hid(hit):
+    return hit.get("user", {}).get("hid")
+
+def _add(a, b):
+    if isinstance(a, tuple):
+        return tuple(x + y for x, y in zip(a, b))
+    return a + b
+
+class ShardedDatabase:
+    # The Database API over N SQLite files, each holding the users whose
+    # shard_index(hid) points at it. Every shard keeps its own writer
+    # connection, lock and WAL; writes are split by hid and applied to the
+    # shards in parallel, reads by hid go to one shard, and counts, queues
+    # and exports are gathered from all of them. Pickup progress and other
+    # state live in shard 0.
+    def __init__(self, db_path=None, shards=None):
+        self.db_path = db_path or Config.DB_FILE
+        self.shard_count = shards or Config.DB_SHARDS
+        self.shards = [Database(path) for path in shard_paths(self.db_path, self.shard_count)]
+        self._executor = ThreadPoolExecutor(max_workers=self.shard_count, thread_name_prefix="shard-writer")
+        for index, shard in enumerate(self.shards):
+            layout = {"index": index, "count": self.shard_count}
+            stored = shard.get_state(LAYOUT_STATE_KEY)
+            if stored is None:
+                shard.set_state(LAYOUT_STATE_KEY, layout)
+            elif stored != layout:
+                self.close()
+                raise ValueError(f"{shard.db_path} belongs to shard layout {stored}, expected {layout}")
+
+    def shard_for(self, hid):
+        return self.shards[shard_index(hid, self.shard_count)]
+
+    def _gather(self, fn):
+        # Cheap reads run shard by shard in the calling thread, so each
+        # thread keeps one reader connection per shard
+        return [fn(shard) for shard in self.shards]
+
+    def _scatter(self, fn):
+        # Runs fn(shard) on every shard in parallel, results in shard order
+        return list(self._executor.map(fn, self.shards))
+
+    def _split(self, kind, payload):
+        # Splits one write into {shard index: payload} by hid
+        if kind == "state":
+            return {0: payload}
+        if kind in ("decisions", "requeue"):
+            hids, extra = payload
+            parts = self._group(hids, lambda hid: hid)
+            return {index: (part, extra) for index, part in parts.items()}
+        key = {"users": _hit_hid, "profiles": lambda item: item[0]}[kind]
+        return self._group(payload, key)
+
+    def _group(self, items, key):
+        parts = {}
+        for item in items:
+            hid = key(item)
+            if hid:
+                parts.setdefault(shard_index(hid, self.shard_count), []).append(item)
+        return parts
+
+    def write_batch(self, writes):
+        per_shard = {}
+        for position, (kind, payload) in enumerate(writes):
+            for index, part in self._split(kind, payload).items():
+                per_shard.setdefault(index, []).append((position, kind, part))
+
+        def apply(index):
+            items = per_shard[index]
+            results = self.shards[index].write_batch([(kind, part) for _, kind, part in items])
+            return [(position, result) for (position, _, _), result in zip(items, results)]
+
+        # Writes that reached no shard (e.g. no hids) report an empty result
+        results = [WRITE_FAILED[kind] for kind, _ in writes]
+        for shard_results in self._executor.map(apply, list(per_shard)):
+            for position, result in shard_results:
+                results[position] = _add(results[position], result)
+        return results
+
+    def save_user(self, user_data):
+        return self.write_batch([("users", [user_data])])[0][0] > 0
+
+    def save_users_bulk(self, hits):
+        return self.write_batch([("users", list(hits))])[0]
+
+    def save_user_profile(self, hid, profile_data):
+        if not hid or not profile_data:
+            return False
+        return self.write_batch([("profiles", [(hid, profile_data)])])[0][0] > 0
+
+    def save_profiles_bulk(self, profiles):
+        return self.write_batch([("profiles", list(profiles))])[0]
+
+    def save_decision(self, hid, decision):
+        return self.save_decisions_bulk([hid], decision) > 0
+
+    def save_decisions_bulk(self, hids, decision):
+        return self.write_batch([("decisions", (list(hids), decision))])[0]
+
+    def requeue_profiles(self, owner, hids):
+        return self.write_batch([("requeue", (list(hids), owner))])[0]
+
+    def set_state(self, key, value):
+        return self.shards[0].set_state(key, value)
+
+    def get_state(self, key, default=None):
+        return self.shards[0].get_state(key, default)
+
+    def get_all_state(self):
+        state = self.shards[0].get_all_state()
+        state.pop(LAYOUT_STATE_KEY, None)
+        return state
+
+    def get_user(self, hid):
+        return self.shard_for(hid).get_user(hid)
+
+    def get_decided_hids(self, decision):
+        return set().union(*self._gather(lambda shard: shard.get_decided_hids(decision)))
+
+    def iter_decisions(self, batch_size=1000):
+        return heapq.merge(*(shard.iter_decisions(batch_size) for shard in self.shards))
+
+    def get_pending_profile_hids(self, limit=100):
+        # The oldest `limit` entries overall are among the oldest `limit` of each shard
+        try:
+            rows = heapq.merge(*self._gather(lambda shard: shard._pending_profiles(limit)))
+            return [hid for _, hid in itertools.islice(rows, limit)]
+        except Exception as e:
+            logger.error(f"Error fetching pending profile hids: {e}")
+            return []
+
+    def get_stale_profile_hids(self, fetched_before, limit=100):
+        try:
+            rows = heapq.merge(*self._gather(lambda shard: shard._stale_profiles(fetched_before, limit)))
+            return [hid for _, hid in itertools.islice(rows, limit)]
+        except Exception as e:
+            logger.error(f"Error fetching stale profile hids: {e}")
+            return []
+
+    def _claim_shares(self, limit):
+        # hids are spread evenly, so each shard leases its share of the
+        # batch; the shares add up to exactly `limit`
+        share, extra = divmod(limit, self.shard_count)
+        return [share + (index < extra) for index in range(self.shard_count)]
+
+    def _claim(self, limit, claim):
+        shares = self._claim_shares(limit)
+        return list(itertools.chain(*(
+            claim(shard, share) for shard, share in zip(self.shards, shares) if share
+        )))
+
+    def claim_profiles(self, owner, limit=100, lease_seconds=None):
+        return self._claim(limit, lambda shard, share: shard.claim_profiles(owner, share, lease_seconds))
+
+    def complete_profiles(self, owner, hids):
+        parts = self._group(hids, lambda hid: hid)
+        return sum(self.shards[index].complete_profiles(owner, part) for index, part in parts.items())
+
+    def reclaim_profiles(self, owner=None):
+        return sum(self._gather(lambda shard: shard.reclaim_profiles(owner)))
+
+    def claim_stale_profiles(self, fetched_before, limit=100, lease_seconds=None):
+        return self._claim(limit, lambda shard, share: shard.claim_stale_profiles(fetched_before, share, lease_seconds))
+
+    def get_users_without_profile(self, limit=100):
+        pending = self.get_pending_profile_hids(limit)
+        users = []
+        for hid in pending:
+            user_data = self.get_user(hid)
+            if user_data is not None:
+                users.append((hid, user_data))
+        return users
+
+    def get_all_users(self, limit=1000, offset=0):
+        return list(itertools.islice(self.iter_users(), offset, offset + limit))
+
+    def _iter_rows(self, batch_size=1000, after_hid=None, fetch_state=False):
+        # Merged by hid, so the stream is ordered exactly like a single file
+        return heapq.merge(
+            *(shard._iter_rows(batch_size, after_hid, fetch_state) for shard in self.shards),
+            key=lambda row: row[0]
+        )
+
+    def iter_users(self, batch_size=1000, raw=False, fields=None, after_hid=None):
+        return format_user_rows(self._iter_rows(batch_size, after_hid), raw, fields)
+
+    def count_users(self, with_profile=False):
+        return sum(self._gather(lambda shard: shard.count_users(with_profile)))
+
+    def count_users_with_profile(self):
+        return self.count_users(with_profile=True)
+
+    def progress_counts(self):
+        counts = self._gather(lambda shard: shard.progress_counts())
+        users, with_profile = sum(users for users, _ in counts), sum(with_profile for _, with_profile in counts)
+        DB_USERS.set(users, profile="any")
+        DB_USERS.set(with_profile, profile="fetched")
+        return users, with_profile
+
+    def recount(self):
+        counts = self._scatter(lambda shard: shard.recount())
+        return sum(users for users, _ in counts), sum(with_profile for _, with_profile in counts)
+
+    def count_where(self, **filters):
+        return sum(self._scatter(lambda shard: shard.count_where(**filters)))
+
+    def find_hids(self, limit=100, **filters):
+        found = self._gather(lambda shard: shard.find_hids(limit, **filters))
+        return list(itertools.islice(itertools.chain(*found), limit))
+
+    def group_count(self, attribute, **filters):
+        totals = Counter()
+        for rows in self._scatter(lambda shard: shard.group_count(attribute, **filters)):
+            for value, count in rows:
+                totals[value] += count
+        return totals.most_common()
+
+    def import_users(self, rows):
+        parts = self._group(rows, lambda row: row[0])
+        return sum(self._executor.map(lambda index: self.shards[index].import_users(parts[index]), list(parts)))
+
+    def import_decisions(self, rows):
+        parts = self._group(rows, lambda row: row[0])
+        return sum(self._executor.map(lambda index: self.shards[index].import_decisions(parts[index]), list(parts)))
+
+    def set_compression(self, algorithm, dictionary=None):
+        for shard in self.shards:
+            shard.set_compression(algorithm, dictionary)
+
+    def recompress(self, batch_size=1000):
+        return sum(self._scatter(lambda shard: shard.recompress(batch_size)))
+
+    def rebuild_user_attrs(self, batch_size=1000):
+        return sum(self._scatter(lambda shard: shard.rebuild_user_attrs(batch_size)))
+
+    def vacuum(self):
+        self._scatter(lambda shard: shard.vacuum())
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for shard in self.shards:
+            shard.close()
@@ -0,0 +1,269 @@
+import json
+import logging
+import os
+import tempfile
+import time
+import json_codec
+from config import Config
+from db import extract_field
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# A snapshot is a directory of column files plus manifest.json. Every run
+# appends one or more parts holding the rows added since the previous run
+# and the rows whose profile was fetched since then, so a hid can appear in
+# several parts; the last occurrence is current, and read_snapshot() drops
+# the others.
+MANIFEST = "manifest.json"
+FORMATS = ("parquet", "npz")
+COLUMN_TYPES = ("INTEGER", "REAL", "TEXT")
+
+def _coerce(value, sql_type):
+    # JSON value -> column value, None when it does not fit the type
+    if value is None or isinstance(value, (dict, list)):
+        return None
+    try:
+        if sql_type == "INTEGER":
+            return int(value)
+        if sql_type == "REAL":
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if isinstance(value, str) else json.dumps(value)
+
+def resolve_format(requested="auto"):
+    if requested == "auto":
+        if pyarrow is not None:
+            return "parquet"
+        if numpy is not None:
+            return "npz"
+        raise RuntimeError("Snapshots need pyarrow (Parquet) or numpy (.npz); install one of them")
+    if requested == "parquet" and pyarrow is None:
+        raise RuntimeError("Parquet snapshots need the pyarrow package")
+    if requested == "npz" and numpy is None:
+        raise RuntimeError(".npz snapshots need the numpy package")
+    return requested
+
+class _PartWriter:
+    # Writes rows of one run into part files of at most part_rows rows.
+    # Parquet parts are streamed one row group per batch; .npz files cannot
+    # be appended to, so a part is held in memory until it is complete.
+    def __init__(self, directory, fmt, columns, first_index, part_rows):
+        self.directory = directory
+        self.format = fmt
+        self.columns = columns
+        self.index = first_index
+        self.part_rows = part_rows
+        self.parts = []
+        self._writer = None
+        self._pending = None
+        self._rows = 0
+        if fmt == "parquet":
+            arrow_types = {"INTEGER": pyarrow.int64(), "REAL": pyarrow.float64(), "TEXT": pyarrow.string()}
+            self.schema = pyarrow.schema([(name, arrow_types[sql_type]) for name, sql_type in columns.items()])
+
+    def _file_name(self):
+        return f"part-{self.index:05d}.{self.format}"
+
+    def write(self, batch):
+        # batch: {column: list of values}, all of the same length
+        offset = 0
+        count = len(batch["hid"])
+        while offset < count:
+            take = min(count - offset, self.part_rows - self._rows)
+            self._append({name: values[offset:offset + take] for name, values in batch.items()})
+            offset += take
+            self._rows += take
+            if self._rows >= self.part_rows:
+                self._finish_part()
+
+    def _append(self, batch):
+        if self.format == "parquet":
+            if self._writer is None:
+                self._writer = pyarrow.parquet.ParquetWriter(os.path.join(self.directory, self._file_name()), self.schema)
+            self._writer.write_table(pyarrow.Table.from_pydict(batch, schema=self.schema))
+        else:
+            if self._pending is None:
+                self._pending = {name: [] for name in self.columns}
+            for name, values in batch.items():
+                self._pending[name].extend(values)
+
+    def _finish_part(self):
+        if not self._rows:
+            return
+        if self.format == "parquet":
+            self._writer.close()
+            self._writer = None
+        else:
+            # Missing numbers become NaN and missing text "", so every
+            # column is a plain typed array that loads without pickle
+            arrays = {}
+            for name, sql_type in self.columns.items():
+                values = self._pending[name]
+                if sql_type == "TEXT":
+                    arrays[name] = numpy.array(["" if value is None else value for value in values], dtype=str)
+                else:
+                    arrays[name] = numpy.array([numpy.nan if value is None else value for value in values], dtype=numpy.float64)
+            numpy.savez_compressed(os.path.join(self.directory, self._file_name()), **arrays)
+            self._pending = None
+        self.parts.append({"file": self._file_name(), "rows": self._rows, "created_at": int(time.time())})
+        self.index += 1
+        self._rows = 0
+
+    def close(self):
+        self._finish_part()
+
+def _load_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def _save_manifest(directory, manifest):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST))
+
+def _check_columns(columns):
+    for name, (source, path, sql_type) in columns.items():
+        if name == "hid" or source not in ("data", "profile_detailed") or sql_type not in COLUMN_TYPES:
+            raise ValueError(f"Invalid snapshot column definition: {name}")
+
+def write_snapshot(db, directory, columns=None, fmt="auto", full=False, batch_size=1000, part_rows=None):
+    # Brings the snapshot in `directory` up to date with db (a Database or
+    # ShardedDatabase) and returns the number of rows written. Starts over
+    # when asked to, when there is no snapshot yet, or when the previous one
+    # cannot be continued (other columns or format, a different shard
+    # layout, or rowids renumbered by VACUUM).
+    columns = Config.SNAPSHOT_COLUMNS if columns is None else columns
+    _check_columns(columns)
+    part_rows = part_rows or Config.SNAPSHOT_PART_ROWS
+    os.makedirs(directory, exist_ok=True)
+    shards = getattr(db, "shards", [db])
+    column_types = {"hid": "TEXT", **{name: sql_type for name, (_, _, sql_type) in columns.items()}}
+
+    manifest = None if full else _load_manifest(directory)
+    if manifest is not None:
+        fmt = manifest["format"] if fmt == "auto" else fmt
+        reason = None
+        if fmt != manifest["format"]:
+            reason = f"it is stored as {manifest['format']}"
+        elif manifest["columns"] != column_types:
+            reason = "its columns differ from the configured ones"
+        elif len(manifest["sources"]) != len(shards):
+            reason = f"it was taken from {len(manifest['sources'])} shard(s)"
+        elif any(
+            source["last_hid"] is not None and shard.hid_at_rowid(source["max_rowid"]) != source["last_hid"]
+            for source, shard in zip(manifest["sources"], shards)
+        ):
+            reason = "rowids changed since (the database was vacuumed or rebuilt)"
+        if reason:
+            logger.warning(f"Rewriting the snapshot in {directory} from scratch: {reason}")
+            manifest = None
+    fmt = resolve_format(fmt)
+
+    if manifest is None:
+        old = _load_manifest(directory)
+        for part in (old or {}).get("parts", []):
+            path = os.path.join(directory, part["file"])
+            if os.path.exists(path):
+                os.remove(path)
+        manifest = {"format": fmt, "columns": column_types, "snapshot_time": None, "sources": [], "parts": []}
+        # Saved at once, so a run that dies halfway starts over next time
+        _save_manifest(directory, manifest)
+        previous = [{"max_rowid": 0, "last_hid": None}] * len(shards)
+        changed_since = None
+    else:
+        previous = manifest["sources"]
+        changed_since = manifest["snapshot_time"]
+
+    # Everything fetched from here on is picked up by the next run
+    started = int(time.time())
+    marks = [shard.last_rowid() for shard in shards]
+    writer = _PartWriter(directory, fmt, column_types, _next_index(manifest), part_rows)
+    paths = [(name, source, path) for name, (source, path, _) in columns.items()]
+    # Profiles are the bigger half of a row; skip decoding them when no column reads them
+    needs_profile = any(source == "profile_detailed" for _, source, _ in paths)
+    written = 0
+    try:
+        for shard, source, (max_rowid, _) in zip(shards, previous, marks):
+            batch = {name: [] for name in column_types}
+            for hid, data, profile in shard.iter_rows_since(source["max_rowid"], max_rowid, changed_since, batch_size):
+                decoded = {
+                    "data": json_codec.loads(data),
+                    "profile_detailed": json_codec.loads(profile) if profile and needs_profile else None
+                }
+                batch["hid"].append(hid)
+                for name, column_source, path in paths:
+                    batch[name].append(_coerce(extract_field(decoded[column_source], path), column_types[name]))
+                if len(batch["hid"]) >= batch_size:
+                    writer.write(batch)
+                    written += len(batch["hid"])
+                    batch = {name: [] for name in column_types}
+            if batch["hid"]:
+                writer.write(batch)
+                written += len(batch["hid"])
+    finally:
+        writer.close()
+
+    manifest["parts"].extend(writer.parts)
+    manifest["snapshot_time"] = started
+    manifest["sources"] = [
+        {"path": os.path.basename(shard.db_path), "max_rowid": max_rowid, "last_hid": last_hid}
+        for shard, (max_rowid, last_hid) in zip(shards, marks)
+    ]
+    _save_manifest(directory, manifest)
+    return written
+
+def _next_index(manifest):
+    if not manifest["parts"]:
+        return 0
+    return int(manifest["parts"][-1]["file"].split("-")[1].split(".")[0]) + 1
+
+def read_snapshot(directory):
+    # The snapshot as one pyarrow.Table (Parquet) or a dict of numpy arrays
+    # (.npz), with superseded copies of a hid dropped
+    manifest = _load_manifest(directory)
+    if manifest is None:
+        raise FileNotFoundError(f"No snapshot in {directory}")
+    fmt = resolve_format(manifest["format"])
+    files = [os.path.join(directory, part["file"]) for part in manifest["parts"]]
+    if fmt == "parquet":
+        if not files:
+            return pyarrow.schema([]).empty_table()
+        table = pyarrow.concat_tables([pyarrow.parquet.read_table(path) for path in files])
+        keep = _last_occurrences(table.column("hid").to_numpy(zero_copy_only=False))
+        return table.take(keep) if keep is not None else table
+    arrays = {name: [] for name in manifest["columns"]}
+    for path in files:
+        with numpy.load(path) as part:
+            for name in arrays:
+                arrays[name].append(part[name])
+    if not files:
+        return {name: numpy.array([]) for name in arrays}
+    columns = {name: numpy.concatenate(parts) for name, parts in arrays.items()}
+    keep = _last_occurrences(columns["hid"])
+    return {name: values[keep] for name, values in columns.items()} if keep is not None else columns
+
+def _last_occurrences(hids):
+    # Sorted positions of the last row of every hid, or None if all are unique
+    if numpy is None:
+        raise RuntimeError("Reading snapshots needs numpy")
+    hids = numpy.asarray(hids)
+    _, first_from_end = numpy.unique(hids[::-1], return_index=True)
+    if len(first_from_end) == len(hids):
+        return None
+    return numpy.sort(len(hids) - 1 - first_from_end)
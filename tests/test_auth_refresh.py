@@ -0,0 +1,103 @@
+import json
+import os
+import time
+import jwt
+import pytest
+from auth import AuthManager
+from config import Config
+from fake_server import REFRESH_PATH, FakeKismia
+from pacer import Pacer
+from utils import HttpTransport
+
+class ScriptedKismia(FakeKismia):
+    # Fails the next requests with the given statuses, then answers normally;
+    # `result` replaces the refreshed tokens in the response body
+    def __init__(self, statuses=(), result=None):
+        super().__init__()
+        self.statuses = list(statuses)
+        self.result = result
+
+    def should_fail(self):
+        if not self.statuses:
+            return False
+        self.error_status = self.statuses.pop(0)
+        return True
+
+    def refreshed_tokens(self):
+        return super().refreshed_tokens() if self.result is None else self.result
+
+def write_tokens(path):
+    expired = jwt.encode({"exp": int(time.time()) - 10}, "test-signing-key-00000000000000000")
+    data = {
+        "accessToken": {"access_token": expired},
+        "refreshToken": {"refresh_token": "refresh-old"},
+        "authToken": "auth-old"
+    }
+    with open(path, "w") as f:
+        json.dump(data, f)
+    return data
+
+@pytest.fixture
+def token_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "auth_token.json")
+    monkeypatch.setattr(Config, "TOKEN_FILE", path)
+    # No pause after a pushback, so retries happen at once
+    monkeypatch.setattr(Config, "RETRY_DELAY", 0)
+    write_tokens(path)
+    return path
+
+def manager_for(fake):
+    manager = AuthManager(HttpTransport(Pacer(rate=0)))
+    manager.refresh_endpoint = f"{fake.start().url}{REFRESH_PATH}"
+    return manager
+
+def test_retryable_status_then_success(token_file):
+    fake = ScriptedKismia(statuses=[503])
+    try:
+        manager = manager_for(fake)
+        assert manager.refresh_tokens()
+    finally:
+        fake.stop()
+    assert fake.requests["refresh"] == 2
+    assert manager.peek_access_token()
+    with open(token_file) as f:
+        assert json.load(f)["refreshToken"]["refresh_token"] != "refresh-old"
+
+def test_client_error_is_not_retried(token_file):
+    fake = ScriptedKismia(statuses=[401, 401, 401])
+    try:
+        manager = manager_for(fake)
+        assert not manager.refresh_tokens()
+    finally:
+        fake.stop()
+    assert fake.requests["refresh"] == 1
+    assert manager.token_data["refreshToken"]["refresh_token"] == "refresh-old"
+
+def test_response_without_result_is_rejected(token_file):
+    fake = ScriptedKismia(result={})
+    try:
+        manager = manager_for(fake)
+        assert not manager.refresh_tokens()
+    finally:
+        fake.stop()
+    assert fake.requests["refresh"] == 1
+    assert manager.peek_access_token() is None
+    with open(token_file) as f:
+        assert json.load(f)["refreshToken"]["refresh_token"] == "refresh-old"
+
+def test_interrupted_save_keeps_the_old_file(token_file, monkeypatch):
+    with open(token_file) as f:
+        original = f.read()
+    manager = AuthManager(HttpTransport(Pacer(rate=0)))
+    manager.token_data["authToken"] = "auth-new"
+
+    def broken_dump(obj, f, **kwargs):
+        f.write('{"accessToken": ')
+        raise OSError("disk full")
+
+    monkeypatch.setattr(json, "dump", broken_dump)
+    manager.save_tokens()
+
+    with open(token_file) as f:
+        assert f.read() == original
+    assert os.listdir(os.path.dirname(token_file)) == [os.path.basename(token_file)]
@@ -0,0 +1,34 @@
+import pytest
+from config import Config
+from db import Database
+from fake_server import FakeKismia
+from fetcher import KismiaAPI
+from pacer import Pacer
+from utils import HttpTransport
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "RETRY_DELAY", 0)
+    db = Database(str(tmp_path / "kismia.db"))
+    api = KismiaAPI(None, db, transport=HttpTransport(Pacer(rate=0)))
+    yield api
+    api.close()
+    api.transport.close()
+    db.close()
+
+@pytest.mark.parametrize("method, route, status, retry_after, attempts", [
+    ("GET", "pick_up", 500, None, 3),
+    ("POST", "like", 500, None, 1),
+    ("POST", "like", 503, None, 1),
+    ("POST", "like", 503, 0, 3),
+    ("POST", "pass", 429, 0, 3),
+])
+def test_only_gets_or_retry_after_are_repeated(api, method, route, status, retry_after, attempts):
+    fake = FakeKismia(error_rate=1.0, error_status=status, retry_after=retry_after).start()
+    path = "/v3/matchesGame/users:pickUp" if route == "pick_up" else f"/v3/matchesGame/users/token:{route}"
+    try:
+        resp = api.make_request(method, f"{fake.url}{path}", json={} if method == "POST" else None)
+    finally:
+        fake.stop()
+    assert resp.status_code == status
+    assert fake.requests[route] == attempts
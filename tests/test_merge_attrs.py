@@ -0,0 +1,54 @@
+import pytest
+from db import Database
+from merge_db import POLICIES, merge_databases
+
+def hit(hid, age):
+    return {"user": {"hid": hid, "age": age, "gender": "f"}}
+
+def make_databases(tmp_path):
+    # Target: 50 users without profiles. Source: 20 of those plus 50 new
+    # ones, all with a profile, fetched later and a year older.
+    target = Database(str(tmp_path / "target.db"))
+    target.save_users_bulk([hit(f"t{i:02d}", 25) for i in range(50)])
+    target.close()
+
+    source = Database(str(tmp_path / "source.db"))
+    hids = [f"t{i:02d}" for i in range(20)] + [f"s{i:02d}" for i in range(50)]
+    source.save_users_bulk([hit(hid, 26) for hid in hids])
+    source.save_profiles_bulk([(hid, {"hid": hid, "city": "Kyiv"}) for hid in hids])
+    with source.transaction() as conn:
+        conn.execute("UPDATE fetch_state SET data_fetched_at = data_fetched_at + 100, profile_fetched_at = profile_fetched_at + 100")
+    source.close()
+    return str(tmp_path / "target.db"), str(tmp_path / "source.db")
+
+def attr_counts(db):
+    return (
+        db.count_where(gender="f"),
+        db.count_where(city="Kyiv"),
+        db.count_where(age=26),
+        sorted(db.group_count("age"))
+    )
+
+@pytest.mark.parametrize("policy", POLICIES)
+def test_merge_indexes_attributes_like_a_full_rebuild(tmp_path, policy):
+    target, source = make_databases(tmp_path)
+    merge_databases([source], target, policy, chunk_size=16)
+
+    db = Database(target)
+    try:
+        merged = attr_counts(db)
+        db.rebuild_user_attrs()
+        assert merged == attr_counts(db)
+    finally:
+        db.close()
+
+def test_fill_profile_counts(tmp_path):
+    target, source = make_databases(tmp_path)
+    merge_databases([source], target, "fill-profile", chunk_size=16)
+
+    db = Database(target)
+    try:
+        assert db.count_where(gender="f") == 100
+        assert db.count_where(city="Kyiv") == 70
+    finally:
+        db.close()
@@ -0,0 +1,20 @@
+from db import Database
+from pipeline import DatabaseWriter
+
+LEASES = "SELECT hid, lease_owner FROM profile_queue ORDER BY hid"
+
+def test_late_requeue_keeps_another_workers_lease(tmp_path):
+    db = Database(str(tmp_path / "kismia.db"))
+    db.save_users_bulk([{"user": {"hid": hid}} for hid in ("h1", "h2")])
+    assert db.claim_profiles("a", limit=2) == ["h1", "h2"]
+    db.complete_profiles("a", ["h1", "h2"])
+    assert db.claim_profiles("b", limit=1) == ["h1"]
+
+    # Worker a's requeue of both hids arrives after b claimed h1
+    writer = DatabaseWriter(db).start()
+    try:
+        assert writer.submit_requeue("a", ["h1", "h2"]).result() == 1
+    finally:
+        writer.close()
+    assert db._get_reader().execute(LEASES).fetchall() == [("h1", "b"), ("h2", None)]
+    db.close()
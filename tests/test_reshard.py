@@ -0,0 +1,49 @@
+import argparse
+import sqlite3
+import time
+import pytest
+from db import Database
+from manage import reshard
+from sharding import ShardedDatabase, shard_paths
+
+FETCH_STATE = "SELECT hid, data_hash, data_fetched_at, profile_hash, profile_fetched_at FROM fetch_state"
+
+def test_reshard_keeps_fetch_state(tmp_path):
+    source_path = str(tmp_path / "kismia.db")
+    db = Database(source_path)
+    hids = [f"h{i:02d}" for i in range(30)]
+    db.save_users_bulk([{"user": {"hid": hid, "age": 30}} for hid in hids])
+    db.save_profiles_bulk([(hid, {"hid": hid, "city": "Kyiv"}) for hid in hids[:20]])
+    with db.transaction() as conn:
+        # Distinct fetch times, so a copy that loses them cannot match by chance
+        conn.execute("UPDATE fetch_state SET profile_fetched_at = 1000 + CAST(substr(hid, 2) AS INTEGER) WHERE profile_fetched_at IS NOT NULL")
+    expected = sorted(db._get_reader().execute(FETCH_STATE).fetchall())
+    db.close()
+
+    target_path = str(tmp_path / "resharded.db")
+    reshard(argparse.Namespace(db=source_path, shards=1, target=target_path, to=3, batch_size=7))
+
+    copied = []
+    for path in shard_paths(target_path, 3):
+        conn = sqlite3.connect(path)
+        copied.extend(conn.execute(FETCH_STATE).fetchall())
+        conn.close()
+    assert sorted(copied) == expected
+
+@pytest.mark.parametrize("limit", [1, 2, 4, 30])
+def test_sharded_claims_stay_within_limit(tmp_path, limit):
+    db = ShardedDatabase(str(tmp_path / "kismia.db"), shards=3)
+    hids = [f"h{i:02d}" for i in range(40)]
+    db.save_users_bulk([{"user": {"hid": hid}} for hid in hids])
+    claimed = db.claim_profiles("a", limit=limit)
+    assert len(claimed) == len(set(claimed)) == limit
+    leased = sum(
+        shard._get_reader().execute("SELECT COUNT(*) FROM profile_queue WHERE lease_owner = 'a'").fetchone()[0]
+        for shard in db.shards
+    )
+    assert leased == limit
+
+    db.save_profiles_bulk([(hid, {"hid": hid}) for hid in hids])
+    stale = db.claim_stale_profiles(time.time() + 60, limit=limit)
+    assert len(stale) == len(set(stale)) == limit
+    db.close()
@@ -1,8 +1,24 @@
 import logging
+import re
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from config import Config
+from pacer import Pacer
+from metrics import REGISTRY
+from profiling import STAGES
 
 logger = logging.getLogger(__name__)
 
+HTTP_REQUESTS = REGISTRY.counter("kismia_http_requests_total", "HTTP requests by endpoint and status", ("endpoint", "status"))
+HTTP_LATENCY = REGISTRY.histogram("kismia_http_request_seconds", "HTTP request latency by endpoint", ("endpoint",))
+
+def endpoint_label(url):
+    # Per-user operation tokens would give every like/pass its own series
+    return re.sub(r"/users/[^/]+:(\w+)$", r"/users/{token}:\1", urlparse(url).path)
+
 class HttpConfig:
     BASE_URL = Config.BASE_URL
     USER_AGENT = "Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Mobile Safari/537.36"
@@ -36,4 +52,61 @@ class HttpConfig:
         if access_token:
             headers["authorization"] = f"JWT {access_token}"
             
-        return headers 
\ No newline at end of file
+        return headers
+
+
+class HttpTransport:
+    # One pooled session per process so connections (and TLS sessions) are
+    # reused across likes, passes, pages and profile requests. Every request
+    # also passes through the shared pacer.
+    def __init__(self, pacer=None):
+        self.pacer = pacer or Pacer()
+        self.session = requests.Session()
+        # Only failed connects are retried here: they never reached the server,
+        # so they need no pacing. Everything else is retried by the callers.
+        retries = Retry(
+            total=Config.MAX_RETRIES - 1,
+            connect=Config.MAX_RETRIES - 1,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=Config.HTTP_RETRY_BACKOFF,
+            allowed_methods=None,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=Config.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=Config.HTTP_POOL_MAXSIZE,
+            max_retries=retries
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.clear()
+        self.session.headers.update(HttpConfig.get_common_headers())
+        if not Config.HTTP_KEEP_ALIVE:
+            self.session.headers["connection"] = "close"
+        self.session.cookies.update(HttpConfig.get_common_cookies())
+    
+    def request(self, method, url, **kwargs):
+        if 'timeout' not in kwargs:
+            kwargs['timeout'] = Config.REQUEST_TIMEOUT
+        self.pacer.acquire()
+        endpoint = endpoint_label(url)
+        start = time.perf_counter()
+        try:
+            resp = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            HTTP_LATENCY.observe(time.perf_counter() - start, endpoint=endpoint)
+            STAGES.add("network", time.perf_counter() - start)
+            HTTP_REQUESTS.inc(endpoint=endpoint, status="error")
+            self.pacer.record(None)
+            raise
+        elapsed = time.perf_counter() - start
+        HTTP_LATENCY.observe(elapsed, endpoint=endpoint)
+        STAGES.add("network", elapsed)
+        HTTP_REQUESTS.inc(endpoint=endpoint, status=resp.status_code)
+        self.pacer.record(resp.status_code, resp.headers.get("Retry-After"))
+        return resp
+    
+    def close(self):
+        self.session.close()